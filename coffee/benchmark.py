@@ -0,0 +1,118 @@
+'''
+    Channel benchmark
+    ~~~~~~~~~~~~~~~~~
+    Measures status dispatches per second against the :class:`FakeChannel`,
+    or with ``--serial`` the status polls per second a device achieves at
+    each baud rate.
+'''
+
+import argparse
+import struct
+import sys
+import time
+
+from coffee import channel
+from coffee.link import DEFAULT_BAUD, negotiate_baud, open_channel
+from coffee.message import (
+    FullStatusMessage,
+    Status1Message,
+    Status2Message,
+    Status3Message
+)
+
+
+def legacy_dispatch (chan, message):
+    ''' The per-dispatch format building ``Channel.dispatch`` used before
+        messages were compiled into codecs.
+    '''
+    output_format = '!B{}'.format(channel.expand_format_string(message.format))
+    input_format = channel.generate_input_format(message.fields)
+
+    assert struct.calcsize(output_format) == 8
+    assert struct.calcsize(input_format) == 8
+
+    packed = struct.pack(output_format, int(message.command), *message.data)
+    chan.send(packed)
+
+    input_data = struct.unpack(input_format, chan.receive())
+    return channel.unpack_message(message.fields, input_data[1:])
+
+
+def compiled_dispatch (chan, message):
+    return chan.dispatch(message)
+
+
+def run (dispatch, count):
+    chan = channel.FakeChannel()
+    messages = [Status1Message(), Status2Message(), Status3Message()]
+
+    start = time.perf_counter()
+    for i in range(count):
+        dispatch(chan, messages[i % 3])
+    return count / (time.perf_counter() - start)
+
+
+def poll (chan, duration):
+    ''' Returns the status polls per second over `duration` seconds. '''
+    messages = [FullStatusMessage()]
+    count = 0
+    start = time.perf_counter()
+
+    while time.perf_counter() - start < duration:
+        try:
+            for message in messages:
+                chan.dispatch(message)
+        except channel.UnsupportedCommand:
+            messages = [Status1Message(), Status2Message(), Status3Message()]
+            continue
+        count += 1
+
+    return count / (time.perf_counter() - start)
+
+
+def serial_benchmark (serial_port, rates, duration, framing):
+    import serial
+
+    print('{:>8} {:>8} {:>10}'.format('baud', 'link', 'polls/s'))
+
+    for rate in rates:
+        with serial.Serial(serial_port, DEFAULT_BAUD, timeout=1) as fp:
+            chan = open_channel(fp, framing, rate)
+            try:
+                print('{:8d} {:8d} {:10.1f}'.format(
+                    rate, fp.baudrate, poll(chan, duration)))
+            finally:
+                negotiate_baud(channel.SerialChannel(fp), fp, DEFAULT_BAUD)
+
+        sys.stdout.flush()
+
+
+def main ():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=100000,
+        help='Number of dispatches per run.')
+    parser.add_argument('-s', '--serial', default=None,
+        help='Poll a device on this serial port instead.')
+    parser.add_argument('-r', '--rates', default='9600,57600,115200,460800',
+        help='Comma separated baud rates to measure with --serial.')
+    parser.add_argument('-d', '--duration', type=float, default=3,
+        help='Seconds to poll at each rate.')
+    parser.add_argument('--no-framing', dest='framing', action='store_false')
+    args = parser.parse_args()
+
+    if args.serial:
+        rates = [int(_) for _ in args.rates.split(',')]
+        serial_benchmark(args.serial, rates, args.duration, args.framing)
+        return 0
+
+    before = run(legacy_dispatch, args.count)
+    after = run(compiled_dispatch, args.count)
+
+    print('legacy   {:10.0f} dispatches/s'.format(before))
+    print('compiled {:10.0f} dispatches/s'.format(after))
+    print('speedup  {:10.2f}x'.format(after / before))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
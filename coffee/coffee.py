@@ -2,6 +2,8 @@
 '''
 
 import argparse
+import asyncio
+import contextlib
 import enum
 import os
 import struct
@@ -11,18 +13,44 @@ import time
 
 import serial
 
-from coffee.channel import SerialChannel, FakeChannel
+from coffee.channel import (
+    SerialChannel,
+    AsyncSerialChannel,
+    ChannelError,
+    FakeChannel,
+    FramedChannel,
+    UnsupportedCommand
+)
+from coffee import output
+from coffee.daemon import DEFAULT_SOCKET, Daemon, DaemonChannel
+from coffee.link import DEFAULT_BAUD, negotiate_baud, open_channel
+from coffee.recorder import Recorder, RecorderError, FORMATS
+from coffee.stats import ChannelStats
 from coffee.output import Progress, Spinner
 from coffee.message import (
+    CommandType,
     Status1Message,
     Status2Message,
     Status3Message,
+    FullStatusMessage,
+    SubscribeMessage,
     SetpointMessage,
     StartPumpMessage,
     StopPumpMessage
 )
 
+#: Seconds between status updates while brewing.
+STREAM_INTERVAL = 0.05
+
+
 def get_status (channel):
+    if channel.full_status:
+        try:
+            return channel.dispatch(FullStatusMessage())
+        except UnsupportedCommand:
+            # Older firmware, use the three 8 byte status messages.
+            channel.full_status = False
+
     retval = {}
     for message in [
             Status1Message(),
@@ -32,6 +60,45 @@ def get_status (channel):
     return retval
 
 
+async def get_status_async (channel):
+    ''' :func:`get_status` for an :class:`AsyncSerialChannel`, the legacy
+        status messages are pipelined.
+    '''
+    if channel.full_status:
+        try:
+            return await channel.dispatch(FullStatusMessage())
+        except UnsupportedCommand:
+            channel.full_status = False
+
+    retval = {}
+    for status in await asyncio.gather(
+            channel.dispatch(Status1Message()),
+            channel.dispatch(Status2Message()),
+            channel.dispatch(Status3Message())):
+        retval.update(status)
+    return retval
+
+
+def status_updates (channel, interval):
+    ''' Yields the status every `interval` seconds. The firmware pushes the
+        records when it supports subscribing, otherwise it is polled.
+    '''
+    if channel.streaming:
+        interval_ms = min(0xffff, max(1, int(interval * 1000)))
+
+        try:
+            message = SubscribeMessage(interval_ms)
+            with channel.stream(message, timeout=interval + 1) as stream:
+                yield from stream
+        except UnsupportedCommand:
+            channel.streaming = False
+
+    # Older firmware, or the stream ran dry.
+    while True:
+        yield get_status(channel)
+        time.sleep(interval)
+
+
 def status_command (args, channel):
     print(''.join([
         'Heater Cycle  On /',
@@ -54,17 +121,18 @@ def status_command (args, channel):
             '        {heater_on:1d}'
         ])
 
-    while True:
-        status = get_status(channel)
+    def show (status):
         sys.stdout.write('\b' * 80)
         sys.stdout.write(fmt.format(**status))
         sys.stdout.write('\r')
         sys.stdout.flush()
 
-        if args.watch:
-            time.sleep(args.watch)
-        else:
-            break
+    if args.watch:
+        with contextlib.closing(status_updates(channel, args.watch)) as updates:
+            for status in updates:
+                show(status)
+    else:
+        show(get_status(channel))
 
     print('')
     return 0
@@ -94,13 +162,15 @@ def start_pump_command (args, channel):
         channel.dispatch(StopPumpMessage())
 
 
-def brew (channel, duration, label=None, include_temperature=False):
+def brew (channel, duration, label=None, include_temperature=False,
+          interval=STREAM_INTERVAL):
     ''' Brew coffee.
 
     :param channel: The channel to use for comms.
     :param duration: Number of seconds to brew.
     :param label: Optional progress bar label.
     :param include_temperature: Include temp reading in label?
+    :param interval: Seconds between status updates.
 
     :returns: The progress bar used (caller should .finish())
     '''
@@ -123,12 +193,15 @@ def brew (channel, duration, label=None, include_temperature=False):
     count = 0
 
     try:
-        while current < duration_ms:
-            status = get_status(channel)
-            temp = status['temp']
-            current = duration_ms - status['pump_on_cycle']
-            progress.label = label.format(temp=temp)
-            progress.update((current + 50) / 1000.0)
+        with contextlib.closing(status_updates(channel, interval)) as updates:
+            for status in updates:
+                temp = status['temp']
+                current = duration_ms - status['pump_on_cycle']
+                progress.label = label.format(temp=temp)
+                progress.update((current + 50) / 1000.0)
+
+                if current >= duration_ms:
+                    break
     except KeyboardInterrupt:
         progress.finish('Aborted', error=True)
         channel.dispatch(StopPumpMessage())
@@ -138,6 +211,78 @@ def brew (channel, duration, label=None, include_temperature=False):
     return progress
 
 
+async def brew_async (channel, duration, label=None, include_temperature=False,
+                      log=None, fps=None):
+    ''' :func:`brew` on an :class:`AsyncSerialChannel`.
+
+    Polling, progress rendering and logging run as separate tasks. Terminal
+    and file writes happen in the default executor, so a slow redraw never
+    delays the next status read.
+
+    :param log: Optional file object, receives a line per status read.
+    :param fps: Maximum progress bar redraws per second.
+    '''
+    assert 2 < duration < 40, "Duration not sane."
+
+    fps = fps or output.FRAME_RATE or 10
+    loop = asyncio.get_running_loop()
+    label = label or ''
+    duration_ms = int(duration * 1000)
+
+    if include_temperature:
+        label = '{} {{temp:6.2f}} C'.format(label)
+
+    status = await get_status_async(channel)
+    progress = Progress(duration, label=label.format(temp=status['temp']),
+                        unit='s')
+    await loop.run_in_executor(None, progress.update, 0)
+
+    await channel.dispatch(StartPumpMessage(duration_ms))
+    start = time.time()
+    latest = {'status': status, 'current': 0}
+    samples = asyncio.Queue()
+    done = asyncio.Event()
+
+    async def poll ():
+        while latest['current'] < duration_ms:
+            status = await get_status_async(channel)
+            latest['status'] = status
+            latest['current'] = duration_ms - status['pump_on_cycle']
+            samples.put_nowait((time.time() - start, status))
+        done.set()
+
+    async def render ():
+        while not done.is_set():
+            progress.label = label.format(temp=latest['status']['temp'])
+            await loop.run_in_executor(None, progress.update,
+                                       (latest['current'] + 50) / 1000.0)
+            try:
+                await asyncio.wait_for(done.wait(), 1.0 / fps)
+            except asyncio.TimeoutError:
+                pass
+
+    async def record ():
+        while not (done.is_set() and samples.empty()):
+            try:
+                t, status = await asyncio.wait_for(samples.get(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            if log is not None:
+                line = '{:.3f}\t{temp:.2f}\t{pump_on_cycle}\n'.format(
+                    t, **status)
+                await loop.run_in_executor(None, log.write, line)
+
+    await asyncio.gather(poll(), render(), record())
+    return progress
+
+
+async def run_brew_async (serial_port, args):
+    async with AsyncSerialChannel(serial_port) as channel:
+        channel.stats = args.channel_stats
+        return await brew_async(channel, args.duration, 'Brewing', True,
+                                log=args.log)
+
+
 def brew_command (args, channel):
 
     if args.preinfuse:
@@ -152,11 +297,94 @@ def brew_command (args, channel):
         progress.finish()
         time.sleep(0.5)
 
-    progress = brew(channel, args.duration, 'Brewing', True)
+    if args.use_async and isinstance(channel, DaemonChannel):
+        print('--async needs the serial port, brewing through the daemon.')
+        args.use_async = False
+
+    if args.use_async:
+        try:
+            progress = asyncio.run(run_brew_async(channel.serial_port, args))
+        except KeyboardInterrupt:
+            channel.dispatch(StopPumpMessage())
+            print('')
+            sys.exit(-1)
+    else:
+        progress = brew(channel, args.duration, 'Brewing', True)
+
     progress.finish('Enjoy!')
     print('')
 
 
+def record_command (args, channel):
+    params = {
+        'Kp': args.kp,
+        'Ki': args.ki,
+        'Kd': args.kd,
+        'setpoint': args.setpoint,
+        'interval': args.interval,
+    }
+    params = {k: v for k, v in params.items() if v is not None}
+
+    recorder = Recorder(args.path, args.format, params,
+                        max_bytes=args.rotate_size and int(
+                            args.rotate_size * 1024 * 1024),
+                        max_age=args.rotate_time)
+    spinner = Spinner('Recording')
+    count = 0
+
+    try:
+        try:
+            with contextlib.closing(status_updates(channel, args.interval)) \
+                    as updates:
+                for status in updates:
+                    recorder.add(status)
+                    count += 1
+                    spinner.spin(count, unit=' samples')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print('')
+            recorder.close()
+    except RecorderError as e:
+        print('{}, {} of {} samples written'.format(e, recorder.samples,
+                                                   count))
+        return -1
+
+    print('Wrote {} samples to {}'.format(recorder.samples,
+                                          ', '.join(recorder.files)))
+    return 0
+
+
+def stats_command (args, channel):
+    spinner = Spinner('Polling')
+
+    for i in range(args.count):
+        try:
+            get_status(channel)
+        except ChannelError:
+            pass
+        spinner.spin(i + 1, unit=' polls')
+        time.sleep(args.interval)
+
+    print('')
+    return 0
+
+
+def daemon_command (args, channel):
+    server = Daemon(args.socket, channel, args.freshness)
+    print('Serving on {}'.format(args.socket))
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        print('\n{} status requests served from the cache, {} from the '
+              'device'.format(server.hits, server.misses))
+
+    return 0
+
+
 def backflush_command (args, channel):
     duration = args.interval
     pause = args.pause
@@ -186,6 +414,20 @@ def main ():
 
     parser.add_argument('-s', '--serial', default=None,
         help='Specify the serial port to use.')
+    parser.add_argument('--fps', type=float, default=output.FRAME_RATE,
+        help='Maximum number of progress redraws per second.')
+    parser.add_argument('-b', '--baud', type=int, default=DEFAULT_BAUD,
+        help='Switch the link to this baud rate.')
+    parser.add_argument('--no-framing', dest='framing', action='store_false',
+        help='Use raw 8 byte requests even if the firmware supports frames.')
+    parser.add_argument('-D', '--daemon', action='store_true',
+        default='COFFEE_DAEMON_SOCKET' in os.environ,
+        help='Talk to a running daemon instead of the serial port.')
+    parser.add_argument('--socket',
+        default=os.getenv('COFFEE_DAEMON_SOCKET', DEFAULT_SOCKET),
+        help='Unix socket of the daemon.')
+    parser.add_argument('--stats', action='store_true',
+        help='Print channel latency and error statistics at exit.')
 
     status_parser = subparsers.add_parser('status')
     status_parser.add_argument('-w', '--watch', required=False,
@@ -204,9 +446,41 @@ def main ():
     brew_parser = subparsers.add_parser('brew')
     brew_parser.add_argument('-H', '--force-heater', type=bool, default=False)
     brew_parser.add_argument('-P', '--preinfuse', type=float, default=0.0)    
+    brew_parser.add_argument('-a', '--async', dest='use_async',
+        action='store_true', help='Poll, render and log concurrently.')
+    brew_parser.add_argument('-l', '--log', type=argparse.FileType('w'),
+        default=None, help='Log status reads to a file (with --async).')
     brew_parser.add_argument('duration', type=float)
     brew_parser.set_defaults(func=brew_command)
 
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('-i', '--interval', type=float, default=0.1,
+        help='Seconds between samples.')
+    record_parser.add_argument('-f', '--format', default='log',
+        choices=sorted(FORMATS), help='postprocess.py log or binary.')
+    record_parser.add_argument('--rotate-size', type=float, default=None,
+        help='Start a new file after this many MiB.')
+    record_parser.add_argument('--rotate-time', type=float, default=None,
+        help='Start a new file after this many seconds.')
+    record_parser.add_argument('--kp', default=None)
+    record_parser.add_argument('--ki', default=None)
+    record_parser.add_argument('--kd', default=None)
+    record_parser.add_argument('--setpoint', default=None)
+    record_parser.add_argument('path')
+    record_parser.set_defaults(func=record_command)
+
+    stats_parser = subparsers.add_parser('stats',
+        help='Poll the status and print channel statistics.')
+    stats_parser.add_argument('-n', '--count', type=int, default=100)
+    stats_parser.add_argument('-i', '--interval', type=float, default=0)
+    stats_parser.set_defaults(func=stats_command)
+
+    daemon_parser = subparsers.add_parser('daemon',
+        help='Share the serial port with other coffee.py invocations.')
+    daemon_parser.add_argument('-f', '--freshness', type=float, default=0.2,
+        help='Seconds a status response is served from the cache.')
+    daemon_parser.set_defaults(func=daemon_command)
+
     backflush_parser = subparsers.add_parser('backflush')
     backflush_parser.add_argument('-I', '--interval', default=12, type=float)
     backflush_parser.add_argument('-P', '--pause', default=6, type=float)
@@ -214,24 +488,61 @@ def main ():
     backflush_parser.set_defaults(func=backflush_command)
 
     args = parser.parse_args()
+    output.FRAME_RATE = args.fps
 
     serial_port = args.serial or \
         os.getenv('COFFEE_SERIAL_PORT', None)
+    use_daemon = args.daemon and args.func is not daemon_command
 
-    if serial_port is None:
+    if serial_port is None and not use_daemon:
         print('Please specify a serial port to use.')
         return -1
 
     retval = -2
+    args.channel_stats = None
+    if args.stats or args.func is stats_command:
+        args.channel_stats = ChannelStats()
+
+    channel = None
 
     try:
-        with serial.Serial(serial_port, 9600) as fp:
+        if use_daemon:
+            try:
+                channel = DaemonChannel(args.socket)
+            except OSError as error:
+                print('{}: {}'.format(args.socket, error.strerror))
+                return -1
+            channel.stats = args.channel_stats
+            try:
+                retval = args.func(args, channel)
+            finally:
+                channel.close()
+            return retval
+
+        with serial.Serial(serial_port, DEFAULT_BAUD, timeout=1) as fp:
             # if True:
-            channel = SerialChannel(fp)
+            channel = open_channel(fp, args.framing, args.baud)
+            if fp.baudrate != args.baud:
+                print('Staying at {} baud, {} was not accepted.'.format(
+                    fp.baudrate, args.baud))
             # channel = FakeChannel()
-            retval = args.func(args, channel)
+            channel.stats = args.channel_stats
+            try:
+                retval = args.func(args, channel)
+            finally:
+                # The next invocation starts at the default rate again.
+                negotiate_baud(SerialChannel(fp), fp, DEFAULT_BAUD)
     except KeyboardInterrupt:
         print('')
+    finally:
+        if args.channel_stats is not None:
+            print(args.channel_stats.report(
+                {int(_): _.name for _ in CommandType}))
+        if args.channel_stats is not None and \
+                isinstance(channel, FramedChannel):
+            print('Framing: {} retransmits, {} CRC errors, {} stale '
+                  'responses'.format(channel.retransmits,
+                                     channel.crc_errors, channel.stale))
 
     return retval
 
@@ -4,10 +4,41 @@
     Serial and mock channels.
 '''
 
+import asyncio
+import binascii
+import collections
+import functools
+import operator
 import struct
 import time
 
 
+#: First byte of every frame pushed by the firmware while subscribed.
+FRAME_SYNC = 0xA5
+
+#: Frames announcing a longer payload are treated as line noise.
+FRAME_MAX_LENGTH = 64
+
+#: First byte of framed requests and responses, no command uses it.
+FRAME_START = 0x7E
+
+
+class ChannelError (Exception):
+    pass
+
+
+class ReadTimeout (ChannelError):
+    ''' Raised when the device sent fewer bytes than expected before the
+        serial read timed out.
+    '''
+
+
+class UnsupportedCommand (ChannelError):
+    ''' Raised when the firmware does not know the command, older firmware
+        echoes the command byte followed by seven zeroes.
+    '''
+
+
 def expand_format_string (format):
     ''' Returns `format` with ``F`` specifiers expanded to ``BB`` '''
     return format.replace('F', 'BB')
@@ -36,6 +67,42 @@ def pack_float (val):
     return (int(val), int(255 * (val - int(val))))
 
 
+def checksum (data):
+    ''' XOR of all bytes in `data`. '''
+    return functools.reduce(operator.xor, data, 0)
+
+
+def pack_frame (kind, payload):
+    ''' Returns a pushed frame: sync byte, `kind`, payload length, payload
+        and the checksum over everything after the sync byte.
+    '''
+    body = bytes([kind, len(payload)]) + bytes(payload)
+    return bytes([FRAME_SYNC]) + body + bytes([checksum(body)])
+
+
+def crc16 (data):
+    ''' CRC-16/CCITT of `data` with an initial value of 0xffff. '''
+    return binascii.crc_hqx(bytes(data), 0xffff)
+
+
+def pack_framed (sequence, payload):
+    ''' Returns a framed request or response: start byte, `sequence`,
+        payload length, payload and the CRC over everything after the start
+        byte.
+    '''
+    body = bytes([sequence, len(payload)]) + bytes(payload)
+    return bytes([FRAME_START]) + body + struct.pack('!H', crc16(body))
+
+
+def expect (data, size):
+    ''' Returns `data`, raises :class:`ReadTimeout` when the read came back
+        short.
+    '''
+    if len(data) < size:
+        raise ReadTimeout('Expected {} bytes, got {}'.format(size, len(data)))
+    return data
+
+
 def unpack_message (fields, data):
     retval = {}
     index = 0
@@ -53,33 +120,265 @@ def unpack_message (fields, data):
     return retval
 
 
+class Codec (object):
+    ''' A message layout compiled into :class:`struct.Struct` objects.
+
+    :param format: The request format of the message (``F`` allowed).
+    :param fields: The ``(format, label)`` fields of the response.
+    :param variable: The response is length prefixed instead of 8 bytes.
+    '''
+
+    def __init__ (self, format, fields, variable=False):
+        self.format = format
+        self.fields = fields
+        self.variable = variable
+        self.output = struct.Struct('!B{}'.format(expand_format_string(format)))
+
+        assert self.output.size == 8
+
+        if variable:
+            # The payload follows a command byte and a length byte.
+            raw_format = ''.join(list(zip(*fields))[0])
+            self.input = struct.Struct('!{}'.format(
+                expand_format_string(raw_format)))
+            self.offset = 2
+            index = 0
+        else:
+            self.input = struct.Struct(generate_input_format(fields))
+            assert self.input.size == 8
+            self.offset = 0
+            # Skip the echoed command byte.
+            index = 1
+
+        # (label, index, is_float) into the unpacked tuple.
+        self.decoders = []
+        for format, label in fields:
+            self.decoders.append((label, index, format == 'F'))
+            index += 2 if format == 'F' else 1
+
+
+    def matches (self, message):
+        return self.format == message.format and \
+            self.fields == message.fields and \
+            self.variable == getattr(message, 'variable', False)
+
+
+    def pack (self, message):
+        return self.output.pack(int(message.command), *message.data)
+
+
+    def decode (self, response):
+        if len(response) != self.offset + self.input.size:
+            raise ChannelError('Expected {} bytes, got {}'.format(
+                self.offset + self.input.size, len(response)))
+
+        data = self.input.unpack_from(response, self.offset)
+        retval = {}
+
+        for label, index, is_float in self.decoders:
+            if is_float:
+                retval[label] = data[index] + (data[index+1] / 255.0)
+            else:
+                retval[label] = data[index]
+
+        return retval
+
+
+_codecs = {}
+
+
+def get_codec (message):
+    ''' Returns the :class:`Codec` for `message`, it is compiled the first
+        time a message of that class is dispatched.
+    '''
+    codec = _codecs.get(type(message))
+
+    if codec is None or not codec.matches(message):
+        codec = Codec(message.format, message.fields,
+            getattr(message, 'variable', False))
+        _codecs[type(message)] = codec
+
+    return codec
+
+
 class Channel (object):
 
-    def dispatch (self, message):
-        output_format = '!B{}'.format(expand_format_string(message.format))
-        output_data = message.data
-        input_format = generate_input_format(message.fields)
+    #: Cleared once the device turned out not to support ``FullStatus``.
+    full_status = True
+
+    #: Cleared once the device turned out not to support subscribing.
+    streaming = True
 
-        assert struct.calcsize(output_format) == 8
-        assert struct.calcsize(input_format) == 8
+    #: Set to a :class:`coffee.stats.ChannelStats` to instrument dispatches.
+    stats = None
 
-        packed = struct.pack(output_format, int(message.command), *output_data)
+    def dispatch (self, message):
+        codec = get_codec(message)
+        packed = codec.pack(message)
+
+        if self.stats is None:
+            return codec.decode(self.exchange(packed, codec.variable))
+
+        command = packed[0]
+        start = time.perf_counter()
+        try:
+            response = self.exchange(packed, codec.variable)
+        except ReadTimeout:
+            self.stats.timeout(command, len(packed))
+            raise
+        except UnsupportedCommand:
+            self.stats.unsupported(command)
+            raise
+
+        self.stats.exchange(command, len(packed), len(response),
+                            time.perf_counter() - start)
+        try:
+            return codec.decode(response)
+        except ChannelError:
+            self.stats.decode_error(command)
+            raise
+
+
+    def exchange (self, packed, variable=False):
+        ''' Sends a packed request and returns the raw response.
+
+        Variable responses start with the command byte and the payload
+        length, a length of zero means the firmware did not recognize the
+        command.
+        '''
         self.send(packed)
 
-        input_data = struct.unpack(input_format, self.receive())
-        unpacked = unpack_message(message.fields, input_data[1:])
-        return unpacked
+        if not variable:
+            return expect(self.receive(), 8)
+
+        header = expect(self.receive(2), 2)
+        if header[1] == 0:
+            expect(self.receive(6), 6)
+            raise UnsupportedCommand(header[0])
+
+        return header + expect(self.receive(header[1]), header[1])
+
+
+    def stream (self, message, timeout=None):
+        ''' Subscribes with `message` and returns a :class:`StatusStream`
+            over the pushed records.
+        '''
+        return StatusStream(self, message, timeout)
 
 
     def send (self, packed):
         raise NotImplementedError()
 
 
-    def receive (self):
+    def receive (self, size=8):
         raise NotImplementedError()
 
 
 
+class StatusStream (object):
+    ''' Iterates over the status records the firmware pushes while
+        subscribed, yielding them as dicts.
+
+    Frames are located by their sync byte and validated by length and
+    checksum, anything else on the line (like the response to a request
+    sent while subscribed) is skipped.
+
+    :param channel: The channel to read from.
+    :param message: A ``SubscribeMessage``, its ``record_fields`` describe
+                    the payload of the pushed records.
+    :param timeout: Seconds without data after which the stream ends, by
+                    default it ends on the first empty read.
+    '''
+
+    def __init__ (self, channel, message, timeout=None):
+        self.channel = channel
+        self.message = message
+        self.timeout = timeout
+        self.codec = Codec(message.format, message.record_fields, variable=True)
+        self.buffer = bytearray()
+        self.subscribed = False
+
+
+    def __enter__ (self):
+        if not self.channel.dispatch(self.message)['accepted']:
+            raise UnsupportedCommand(int(self.message.command))
+        self.subscribed = True
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+
+    def __iter__ (self):
+        while self.subscribed:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            if frame[0] == self.message.record_kind:
+                yield self.codec.decode(frame)
+
+
+    def close (self):
+        ''' Unsubscribes and skips the remaining records up to the end of
+            stream frame.
+        '''
+        if not self.subscribed:
+            return
+
+        self.subscribed = False
+        self.message.interval = 0
+        self.channel.send(get_codec(self.message).pack(self.message))
+
+        while True:
+            frame = self.read_frame()
+            if frame is None or frame[0] == self.message.command:
+                break
+
+        self.buffer.clear()
+
+
+    def read_frame (self):
+        ''' Returns the next valid frame without the sync and checksum
+            bytes, or None when the channel ran dry.
+        '''
+        buf = self.buffer
+        last_data = time.monotonic()
+
+        while True:
+            start = buf.find(FRAME_SYNC)
+            if start < 0:
+                del buf[:]
+            elif start > 0:
+                del buf[:start]
+
+            needed = 3
+            if len(buf) >= 3:
+                if buf[2] > FRAME_MAX_LENGTH:
+                    del buf[0]
+                    continue
+                needed = buf[2] + 4
+
+            if len(buf) < needed:
+                data = self.channel.receive(needed - len(buf))
+                if data:
+                    last_data = time.monotonic()
+                elif self.timeout is None or \
+                        time.monotonic() - last_data > self.timeout:
+                    return None
+                buf.extend(data)
+                continue
+
+            body = bytes(buf[1:needed - 1])
+            if checksum(body) != buf[needed - 1]:
+                # Not a frame after all, resync after this sync byte.
+                del buf[0]
+                continue
+
+            del buf[:needed]
+            return body
+
+
 class SerialChannel (Channel):
 
     def __init__ (self, serial_port):
@@ -90,8 +389,273 @@ class SerialChannel (Channel):
         self.serial_port.write(packed)
 
 
-    def receive (self):
-        return self.serial_port.read(8)
+    def receive (self, size=8):
+        return self.serial_port.read(size)
+
+
+class FramedChannel (Channel):
+    ''' Exchanges framed requests over `channel`.
+
+    Every request gets a sequence number. A response with a bad CRC is
+    skipped by resyncing on the next start byte, a response to an older
+    request is discarded. Without a valid response within `timeout` the
+    same frame is sent again up to `retries` times; the firmware answers a
+    repeated sequence number with its cached response, so a retried command
+    doesn't run twice.
+
+    Check with a ``FramingMessage`` that the firmware supports framing
+    before using this. Pushed status frames are read unframed from the
+    underlying channel.
+
+    :param channel: The raw channel, usually a :class:`SerialChannel`.
+    :param retries: Number of times a request is sent again.
+    :param timeout: Seconds to wait for each response, reads can take up to
+                    the serial port timeout longer.
+    '''
+
+    def __init__ (self, channel, retries=3, timeout=0.5):
+        self.channel = channel
+        self.retries = retries
+        self.timeout = timeout
+        self.sequence = 0
+        self.buffer = bytearray()
+
+        self.retransmits = 0
+        self.crc_errors = 0
+        self.stale = 0
+
+
+    @property
+    def serial_port (self):
+        return self.channel.serial_port
+
+
+    def exchange (self, packed, variable=False):
+        self.sequence = (self.sequence + 1) & 0xff
+        frame = pack_framed(self.sequence, packed)
+
+        for attempt in range(1 + self.retries):
+            if attempt > 0:
+                self.retransmits += 1
+            self.channel.send(frame)
+
+            response = self.read_response(self.sequence)
+            if response is not None:
+                break
+        else:
+            raise ReadTimeout('No response to command {} after {} '
+                              'attempts'.format(packed[0], 1 + self.retries))
+
+        if variable and len(response) >= 2 and response[1] == 0:
+            raise UnsupportedCommand(response[0])
+
+        return response
+
+
+    def send (self, packed):
+        ''' Sends a framed request without waiting for its response. '''
+        self.sequence = (self.sequence + 1) & 0xff
+        self.channel.send(pack_framed(self.sequence, packed))
+
+
+    def receive (self, size=8):
+        return self.channel.receive(size)
+
+
+    def read_response (self, sequence):
+        ''' Returns the payload of the response to `sequence`, or None
+            when it didn't arrive in time.
+        '''
+        buf = self.buffer
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            start = buf.find(FRAME_START)
+            if start < 0:
+                del buf[:]
+            elif start > 0:
+                del buf[:start]
+
+            needed = 3
+            if len(buf) >= 3:
+                if buf[2] > FRAME_MAX_LENGTH:
+                    del buf[0]
+                    continue
+                needed = buf[2] + 5
+
+            if len(buf) < needed:
+                if time.monotonic() > deadline:
+                    return None
+                buf.extend(self.channel.receive(needed - len(buf)))
+                continue
+
+            body = bytes(buf[1:needed - 2])
+            crc, = struct.unpack_from('!H', buf, needed - 2)
+            if crc16(body) != crc:
+                self.crc_errors += 1
+                del buf[0]
+                continue
+
+            del buf[:needed]
+            if body[0] != sequence:
+                self.stale += 1
+                continue
+
+            return body[2:]
+
+
+class AsyncSerialChannel (object):
+    ''' Asyncio channel that keeps several requests in flight.
+
+    Requests are written as soon as they are dispatched, a single reader
+    task matches each response to the oldest pending request with the same
+    command byte. Blocking serial reads run in the default executor.
+
+    A request that timed out is kept as a discard marker for another
+    timeout, so a late response doesn't go to the next request, and is
+    dropped after that in case its response was lost. If a marker took a
+    response after a later request was written, that response may have
+    been the later one's, so when that request times out too it leaves no
+    marker. Bytes that match no pending command are skipped one at a time
+    to find the next response.
+
+    :param serial_port: An open serial port, it should have a read timeout.
+    :param timeout: Default seconds to wait for each response.
+    '''
+
+    #: Cleared once the device turned out not to support ``FullStatus``.
+    full_status = True
+
+    #: Set to a :class:`coffee.stats.ChannelStats` to instrument dispatches.
+    stats = None
+
+    def __init__ (self, serial_port, timeout=1.0):
+        self.serial_port = serial_port
+        self.timeout = timeout
+        self.pending = collections.defaultdict(collections.deque)
+        self.absorbed = {}
+        self.reader = None
+
+
+    async def __aenter__ (self):
+        return self
+
+
+    async def __aexit__ (self, *exc_info):
+        await self.close()
+
+
+    async def dispatch (self, message, timeout=None):
+        codec = get_codec(message)
+        future = asyncio.get_running_loop().create_future()
+
+        # Queue before writing so a fast response always finds its request.
+        command = int(message.command)
+        queue = self.pending[command]
+        self.expire(queue)
+        entry = [codec, future, None]
+        queue.append(entry)
+        if self.reader is None:
+            self.reader = asyncio.ensure_future(self.run())
+        packed = codec.pack(message)
+        self.serial_port.write(packed)
+        written = time.monotonic()
+        start = time.perf_counter()
+        timeout = timeout or self.timeout
+
+        try:
+            response = await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if self.absorbed.get(command, written) > written:
+                if entry in queue:
+                    queue.remove(entry)
+            else:
+                entry[2] = time.monotonic() + timeout
+            if self.stats is not None and \
+                    isinstance(e, asyncio.TimeoutError):
+                self.stats.timeout(packed[0], len(packed))
+            raise
+        except UnsupportedCommand:
+            if self.stats is not None:
+                self.stats.unsupported(packed[0])
+            raise
+
+        if self.stats is None:
+            return codec.decode(response)
+
+        self.stats.exchange(packed[0], len(packed), len(response),
+                            time.perf_counter() - start)
+        try:
+            return codec.decode(response)
+        except ChannelError:
+            self.stats.decode_error(packed[0])
+            raise
+
+
+    async def close (self):
+        if self.reader is not None:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+            self.reader = None
+
+
+    @staticmethod
+    def expire (queue):
+        ''' Drops the discard markers at the head of `queue` that ran out,
+            their responses were lost.
+        '''
+        now = time.monotonic()
+        while queue and queue[0][2] is not None and queue[0][2] < now:
+            queue.popleft()
+
+
+    async def read (self, size):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.serial_port.read, size)
+
+
+    async def run (self):
+        while True:
+            response = await self.read(1)
+            if not response:
+                continue
+
+            queue = self.pending.get(response[0])
+            if queue:
+                self.expire(queue)
+
+            if not queue:
+                # Not a response we wait for, resync on the next byte.
+                continue
+
+            codec, future, deadline = queue.popleft()
+            if deadline is not None:
+                self.absorbed[response[0]] = time.monotonic()
+            error = None
+
+            if codec.variable:
+                response += await self.read(1)
+                if len(response) < 2:
+                    error = ChannelError('Short read')
+                elif response[1] == 0:
+                    await self.read(6)
+                    error = UnsupportedCommand(response[0])
+                else:
+                    response += await self.read(response[1])
+            else:
+                response += await self.read(7)
+
+            if future.done():
+                # Its request timed out.
+                continue
+
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(response)
 
 
 class FakeChannel (Channel):
@@ -108,10 +672,11 @@ class FakeChannel (Channel):
             'pump_on': False,
             'power': 0.42,
         }
-        self.retval = None
+        self.retval = b''
+        self.interval = 0
 
 
-    def send (self, packed):
+    def tick (self):
         diff = 1000 * (time.time() - self.last_call)
         self.last_call = time.time()
         self.status['pump_on_cycle'] -= int(diff)
@@ -122,8 +687,12 @@ class FakeChannel (Channel):
         else:
             self.status['pump_on'] = True
 
+
+    def send (self, packed):
+        self.tick()
+
         if packed[0] == 1:
-            self.retval = struct.pack('!BHHH?', 1,
+            self.retval += struct.pack('!BHHH?', 1,
                 self.status['heater_on_cycle'],
                 self.status['heater_off_cycle'],
                 self.status['dt'],
@@ -131,25 +700,61 @@ class FakeChannel (Channel):
 
         elif packed[0] == 2:
             v1, v2 = pack_float(self.status['temp'])
-            self.retval = struct.pack('!BLBB?', 2,
+            self.retval += struct.pack('!BLBB?', 2,
                 self.status['pump_on_cycle'], v1, v2,
                 self.status['pump_on'])
 
         elif packed[0] == 3:
             v1, v2 = pack_float(self.status['power'])
-            self.retval = struct.pack('!BBBBBBBB', 3, v1, v2, 0, 0, 0, 0, 0)
+            self.retval += struct.pack('!BBBBBBBB', 3, v1, v2, 0, 0, 0, 0, 0)
+
+        elif packed[0] == 4:
+            self.retval += bytes([4, 16]) + self.full_status()
+
+        elif packed[0] == 5:
+            _, interval, *_ = struct.unpack('!BHBBBBB', packed)
+            if interval:
+                self.retval += struct.pack('!BH?BBBB', 5, interval, True,
+                    0, 0, 0, 0)
+            elif self.interval:
+                self.retval += pack_frame(5, b'')
+            self.interval = interval
 
         elif packed[0] == 10:
             _, v1, v2, *_ = struct.unpack('!BBBBBBBB', packed)
             old = self.status['temp']
             self.status['temp'] = unpack_float(v1, v2)
             a1, a2 = pack_float(old)
-            self.retval = struct.pack('!BBBBBBBB', 10, v1, v2, a1, a2, 0, 0, 0)
+            self.retval += struct.pack('!BBBBBBBB', 10, v1, v2, a1, a2, 0, 0, 0)
 
         elif packed[0] == 20:
             _, self.status['pump_on_cycle'], *_ = struct.unpack('!BHBBBBB', packed)
-            self.retval = struct.pack('!BBBBBBBB', 20, 0, 0, 0, 0, 0, 0, 0)
-
-    def receive (self):
-        return self.retval
+            self.retval += struct.pack('!BBBBBBBB', 20, 0, 0, 0, 0, 0, 0, 0)
+
+    def receive (self, size=8):
+        if self.interval and len(self.retval) < size:
+            self.retval += self.record()
+
+        retval, self.retval = self.retval[:size], self.retval[size:]
+        return retval
+
+
+    def full_status (self):
+        ''' Returns the ``FullStatus`` payload. '''
+        t1, t2 = pack_float(self.status['temp'])
+        p1, p2 = pack_float(self.status['power'])
+        return struct.pack('!HHH?LBB?BB',
+            self.status['heater_on_cycle'],
+            self.status['heater_off_cycle'],
+            self.status['dt'],
+            self.status['heater_on'],
+            self.status['pump_on_cycle'], t1, t2,
+            self.status['pump_on'], p1, p2)
+
+
+    def record (self):
+        ''' Returns a pushed status record frame. '''
+        self.tick()
+        millis = int(1000 * time.time()) & 0xffffffff
+        return pack_frame(4, struct.pack('!L', millis) + self.full_status())
 
@@ -0,0 +1,191 @@
+'''
+    coffee.daemon
+    ~~~~~~~~~~~~~
+    Shares one serial link between several clients.
+
+    The daemon owns the channel and serves requests from a Unix socket. A
+    request is a flags byte (bit 0: variable length response) and the 8
+    byte packed message, the reply is a result byte, the response length
+    and the raw response. Status responses are cached for a short time, so
+    clients polling together only cost one exchange on the serial link.
+'''
+
+import os
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+from .channel import Channel, ChannelError, UnsupportedCommand
+
+
+#: Socket used when none is given.
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+                              'coffee-{}.sock'.format(os.getuid()))
+
+#: Commands whose responses are cached, the status requests.
+CACHED_COMMANDS = (1, 2, 3, 4)
+
+#: Commands that change the link itself (subscribing, framing and baud
+#: rate) belong to the daemon, clients get them refused.
+LINK_COMMANDS = (5, 6, 7)
+
+REQUEST = struct.Struct('!B8s')
+REPLY = struct.Struct('!BB')
+
+RESULT_OK = 0
+RESULT_UNSUPPORTED = 1
+RESULT_ERROR = 2
+
+
+def receive_exactly (sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class Handler (socketserver.BaseRequestHandler):
+
+    def handle (self):
+        while True:
+            request = receive_exactly(self.request, REQUEST.size)
+            if request is None:
+                return
+
+            flags, packed = REQUEST.unpack(request)
+            result, response = self.server.exchange(packed, bool(flags & 1))
+            self.request.sendall(REPLY.pack(result, len(response)) + response)
+
+
+class Daemon (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' Serves `channel` on the Unix socket at `path`.
+
+    :param channel: The channel to share, usually over a serial port.
+    :param freshness: Seconds a cached status response is served for.
+    '''
+
+    daemon_threads = True
+
+    def __init__ (self, path, channel, freshness=0.2):
+        self.path = path
+        self.channel = channel
+        self.freshness = freshness
+        self.lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.exists(path):
+            if self.is_running(path):
+                raise RuntimeError('{}: daemon already running'.format(path))
+            os.unlink(path)
+
+        super().__init__(path, Handler)
+
+
+    @staticmethod
+    def is_running (path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+
+    def server_close (self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+    def count (self, hit):
+        # Cache hits are served outside the channel lock, by many threads.
+        with self.counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+    def exchange (self, packed, variable):
+        ''' Returns ``(result, response)`` for a request of a client. '''
+        command = packed[0]
+        if command in LINK_COMMANDS:
+            return RESULT_UNSUPPORTED, b''
+
+        if command in CACHED_COMMANDS:
+            entry = self.cache.get(packed)
+            if entry is not None and \
+                    time.monotonic() - entry[0] < self.freshness:
+                self.count(hit=True)
+                return RESULT_OK, entry[1]
+
+        with self.lock:
+            # Another client may have refreshed it while we waited.
+            entry = self.cache.get(packed)
+            if entry is not None and \
+                    time.monotonic() - entry[0] < self.freshness:
+                self.count(hit=True)
+                return RESULT_OK, entry[1]
+
+            try:
+                response = self.channel.exchange(packed, variable)
+            except UnsupportedCommand:
+                return RESULT_UNSUPPORTED, b''
+            except ChannelError:
+                return RESULT_ERROR, b''
+
+            if command in CACHED_COMMANDS:
+                self.count(hit=False)
+                self.cache[packed] = (time.monotonic(), bytes(response))
+            else:
+                # Setpoint and pump commands change the status.
+                self.cache.clear()
+
+        return RESULT_OK, bytes(response)
+
+
+class DaemonChannel (Channel):
+    ''' A channel to the :class:`Daemon` at `path`. '''
+
+    #: Pushed records need the link to themselves, clients poll instead.
+    streaming = False
+
+    def __init__ (self, path=DEFAULT_SOCKET):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+
+    def close (self):
+        self.sock.close()
+
+
+    def exchange (self, packed, variable=False):
+        self.sock.sendall(REQUEST.pack(int(variable), packed))
+
+        header = receive_exactly(self.sock, REPLY.size)
+        if header is None:
+            raise ChannelError('{}: daemon closed the connection'.format(
+                self.path))
+
+        result, size = REPLY.unpack(header)
+        response = receive_exactly(self.sock, size) if size else b''
+
+        if result == RESULT_UNSUPPORTED:
+            raise UnsupportedCommand(packed[0])
+        elif result != RESULT_OK or response is None:
+            raise ChannelError('Command {} failed on the serial link'.format(
+                packed[0]))
+
+        return response
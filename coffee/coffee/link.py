@@ -0,0 +1,78 @@
+'''
+    coffee.link
+    ~~~~~~~~~~~
+    Serial link setup.
+'''
+
+import time
+
+from .channel import ChannelError, FramedChannel, SerialChannel
+from .message import BaudMessage, FramingMessage, Status1Message
+
+
+#: Baud rate the firmware starts with.
+DEFAULT_BAUD = 9600
+
+#: Seconds the firmware waits for a request at a new rate before it goes
+#: back to the old one (``BAUD_CONFIRM_TIMEOUT``), plus some margin.
+BAUD_CONFIRM_TIMEOUT = 1.2
+
+
+def negotiate_baud (channel, serial_port, baud, attempts=3):
+    ''' Switches the link to `baud` and returns the rate in use afterwards.
+
+    The firmware acknowledges at the current rate and switches, then the
+    link is confirmed with a status request at the new rate. If that fails
+    the port goes back to the old rate, which the firmware returns to on
+    its own after :data:`BAUD_CONFIRM_TIMEOUT`.
+
+    :param channel: A raw channel over `serial_port`.
+    '''
+    previous = serial_port.baudrate
+    if baud == previous:
+        return baud
+
+    try:
+        accepted = channel.dispatch(BaudMessage(baud))['accepted']
+    except ChannelError:
+        accepted = False
+
+    if not accepted:
+        return previous
+
+    serial_port.baudrate = baud
+    for attempt in range(attempts):
+        serial_port.reset_input_buffer()
+        try:
+            channel.dispatch(Status1Message())
+            return baud
+        except ChannelError:
+            # Let the firmware drop the partial request.
+            time.sleep(0.1)
+
+    serial_port.baudrate = previous
+    time.sleep(BAUD_CONFIRM_TIMEOUT)
+    serial_port.reset_input_buffer()
+    return previous
+
+
+def open_channel (serial_port, framing=True, baud=None):
+    ''' Returns a channel over `serial_port`.
+
+    :param framing: Use a :class:`FramedChannel` when the firmware supports
+                    framed requests, otherwise a plain :class:`SerialChannel`.
+    :param baud: Negotiate this baud rate first.
+    '''
+    channel = SerialChannel(serial_port)
+
+    if baud is not None:
+        negotiate_baud(channel, serial_port, baud)
+
+    if framing:
+        try:
+            if channel.dispatch(FramingMessage())['accepted']:
+                return FramedChannel(channel)
+        except ChannelError:
+            pass
+
+    return channel
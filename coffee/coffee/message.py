@@ -13,6 +13,10 @@ class CommandType (enum.IntEnum):
     Status1      = 1
     Status2      = 2
     Status3      = 3
+    FullStatus   = 4
+    Subscribe    = 5
+    Framing      = 6
+    Baud         = 7
     Setpoint     = 10
     StartPump    = 20
     StopPump     = 21
@@ -27,6 +31,10 @@ class Message (object):
     #: item should be a ``(format, name)`` tuple.
     fields = []
 
+    #: Set to True when the response is length prefixed instead of 8 bytes,
+    #: `fields` is then not limited to 7 bytes.
+    variable = False
+
 
 class Status1Message (Message):
     command = CommandType.Status1
@@ -60,6 +68,75 @@ class Status3Message (Message):
     data = [0, 0, 0, 0, 0, 0, 0]
 
 
+class FullStatusMessage (Message):
+    command = CommandType.FullStatus
+    format = 'BBBBBBB'
+    variable = True
+    fields = Status1Message.fields + Status2Message.fields + \
+        Status3Message.fields
+    data = [0, 0, 0, 0, 0, 0, 0]
+
+
+class SubscribeMessage (Message):
+    ''' Makes the firmware push a status record every `interval` ms, an
+        interval of 0 ends the subscription.
+    '''
+    command = CommandType.Subscribe
+    format = 'HBBBBB'
+    fields = [
+        ('H', 'interval'),
+        ('?', 'accepted'),
+    ]
+
+    #: Pushed records are ``FullStatus`` frames prefixed with a timestamp.
+    record_kind = CommandType.FullStatus
+    record_fields = [('L', 'millis')] + FullStatusMessage.fields
+
+
+    def __init__ (self, interval):
+        self.interval = interval
+
+
+    @property
+    def data (self):
+        return [self.interval] + [0] * 5
+
+
+class FramingMessage (Message):
+    ''' Asks whether the firmware understands framed requests, older
+        firmware echoes the command with ``accepted`` cleared.
+    '''
+    command = CommandType.Framing
+    format = 'BBBBBBB'
+    fields = [
+        ('?', 'accepted'),
+        ('B', 'version'),
+    ]
+    data = [0] * 7
+
+
+class BaudMessage (Message):
+    ''' Asks the firmware to switch to `baud` after responding. It goes
+        back to the old rate unless a valid request arrives at the new one
+        within a second.
+    '''
+    command = CommandType.Baud
+    format = 'LBBB'
+    fields = [
+        ('?', 'accepted'),
+        ('L', 'baud'),
+    ]
+
+
+    def __init__ (self, baud):
+        self.baud = baud
+
+
+    @property
+    def data (self):
+        return [self.baud, 0, 0, 0]
+
+
 class SetpointMessage (Message):
     command = CommandType.Setpoint
     format = 'BBBBBBB'
@@ -5,28 +5,118 @@
 '''
 
 import itertools
-import os
+import shutil
+import signal
 import sys
+import threading
 import time
 
 from termcolor import colored
 
 
+#: Default maximum number of redraws per second.
+FRAME_RATE = 30
+
+
+class TerminalGeometry (object):
+    ''' Caches the terminal size.
+
+    The cache is refreshed on ``SIGWINCH`` when the handler could be
+    installed (main thread, POSIX), otherwise once it is older than
+    `max_age` seconds.
+    '''
+
+    def __init__ (self, max_age=1.0):
+        self.max_age = max_age
+        self.size = None
+        self.updated = 0
+        self.installed = False
+        self.previous_handler = None
+
+
+    def install (self):
+        if self.installed or not hasattr(signal, 'SIGWINCH') or \
+                threading.current_thread() is not threading.main_thread():
+            return
+
+        self.previous_handler = signal.signal(signal.SIGWINCH, self.on_resize)
+        self.installed = True
+
+
+    def on_resize (self, signum, frame):
+        self.size = None
+        if callable(self.previous_handler):
+            self.previous_handler(signum, frame)
+
+
+    def refresh (self):
+        self.size = shutil.get_terminal_size()
+        self.updated = time.monotonic()
+
+
+    @property
+    def columns (self):
+        self.install()
+        if self.size is None or (not self.installed and
+                time.monotonic() - self.updated > self.max_age):
+            self.refresh()
+        return self.size.columns
+
+
+geometry = TerminalGeometry()
+
+
 def get_window_width ():
-    rows, columns = os.popen('stty size', 'r').read().split()
-    return int(columns)
+    return geometry.columns
 
 
-class ClearMixin (object):
+class Renderer (object):
+    ''' Writes frames to `fp`.
 
-    def clear (self):
-        cols = get_window_width()
-        self.fp.write('\b' * cols)
+    A frame is written with a single write call and only when it differs
+    from the previous frame, frames that follow the previous write within
+    ``1 / fps`` seconds are dropped unless forced. `fps` defaults to
+    :data:`FRAME_RATE`, 0 disables the limit.
+    '''
+
+    def __init__ (self, fp=sys.stdout, fps=None):
+        self.fp = fp
+        self.fps = fps
+        self.last_frame = None
+        self.last_draw = 0
+
+
+    def ready (self, force=False):
+        ''' Returns False while a new frame would exceed the rate limit. '''
+        fps = FRAME_RATE if self.fps is None else self.fps
+        return force or not fps or \
+            time.monotonic() - self.last_draw >= 1.0 / fps
+
+
+    def render (self, frame, force=False):
+        if frame == self.last_frame or not self.ready(force):
+            return False
+
+        self.write(frame)
+        self.last_frame = frame
+        return True
+
+
+    def write (self, text):
+        ''' Writes `text` right away, the next frame is always drawn. '''
+        self.fp.write(text)
+        self.fp.flush()
+        self.last_frame = None
+        self.last_draw = time.monotonic()
+
+
+def clear_sequence ():
+    return '\b' * get_window_width()
 
 
-class Spinner (ClearMixin):
+class Spinner (object):
 
-    def __init__ (self, label=None, fp=sys.stdout):
+    def __init__ (self, label=None, fp=sys.stdout, fps=None):
         self.iter = itertools.cycle([
                 '|',
                 '/',
@@ -35,37 +125,44 @@ class Spinner (ClearMixin):
             ])
         self.label = label
         self.fp = fp
+        self.renderer = Renderer(fp, fps)
 
 
     def spin (self, counter=None, unit=None):
-        self.clear()
-        self.fp.write('    ')
-        self.fp.write(next(self.iter))
+        if not self.renderer.ready():
+            return
+
+        parts = [clear_sequence(), '    ', next(self.iter)]
 
         if self.label:
-            self.fp.write('  {}'.format(self.label))
+            parts.append('  {}'.format(self.label))
 
         if counter:
             unit = unit or ''
-            self.fp.write('  ({:.1f}{})'.format(counter, unit))
-        self.fp.write('\r')
+            parts.append('  ({:.1f}{})'.format(counter, unit))
+        parts.append('\r')
 
-        self.fp.flush()
+        self.renderer.render(''.join(parts))
 
 
-class Progress (ClearMixin):
+class Progress (object):
 
-    def __init__ (self, target, label=None, fp=sys.stdout, unit=None):
+    def __init__ (self, target, label=None, fp=sys.stdout, unit=None,
+                  fps=None):
         self.label = label
         self.target = target
         self.current = 0
         self.fp = fp
         self.unit = unit
         self.prefix_length = 0
+        self.renderer = Renderer(fp, fps)
 
 
-    def update (self, current, color=None):
+    def update (self, current, color=None, force=False):
         self.current = current
+        if not self.renderer.ready(force):
+            return
+
         width = get_window_width()
         color = color or 'on_cyan'
 
@@ -92,15 +189,14 @@ class Progress (ClearMixin):
 
         N = width - len(suffix) - len(prefix) - 5
         n = int(ratio * N)
-        point = '>' if n < N else '='
 
-        self.clear()
-        self.fp.write(prefix)
-        self.fp.write('{}{}'.format(
+        self.renderer.render(''.join([
+            '\b' * width,
+            prefix,
             colored(' ' * n, 'yellow', color, attrs=['bold']),
-            colored(' ' * (N - n), 'white', 'on_blue')))
-        self.fp.write(suffix)
-        self.fp.flush()
+            colored(' ' * (N - n), 'white', 'on_blue'),
+            suffix,
+        ]), force)
 
 
     def run (self, increment, sleep):
@@ -111,9 +207,7 @@ class Progress (ClearMixin):
 
     def finish (self, label=None, error=False):
         color = 'on_red' if error else None
-        self.update(self.target, color=color)
+        self.update(self.target, color=color, force=True)
         if label:
             ws = self.prefix_length - 8 - len(label)
-            self.fp.write('\r    {}    '.format(label))
-            if ws > 0:
-                self.fp.write(' ' * ws)
+            self.renderer.write('\r    {}    {}'.format(label, ' ' * ws))
@@ -0,0 +1,219 @@
+'''
+    coffee.recorder
+    ~~~~~~~~~~~~~~~
+    Buffered telemetry recording.
+'''
+
+import json
+import os
+import queue
+import struct
+import threading
+import time
+
+
+#: Columns of recorded samples, the ``postprocess.py`` log columns.
+HEADERS = ['On', 'T', 'Output', 'dt', 'cycle', 't']
+
+#: First bytes of a binary recording.
+MAGIC = b'CREC\x00\x01\r\n'
+
+#: A binary record, the same column types as ``util/teensylog.py`` uses.
+RECORD = struct.Struct('<BffHII')
+
+
+class RecorderError (Exception):
+    ''' The writer thread failed, samples from then on are lost. '''
+
+
+def sample_row (sample):
+    ''' Returns the :data:`HEADERS` values of a ``(t, status)`` sample. '''
+    t, status = sample
+    return (int(status['heater_on']), status['temp'], status['power'],
+            status['dt'], status['heater_on_cycle'], int(t) & 0xffffffff)
+
+
+class LogFormat (object):
+    ''' The tab separated ``postprocess.py`` log format. '''
+
+    extension = '.log'
+    binary = False
+
+    def header (self, date, params):
+        fields = [date] + ['{}={}'.format(k, v) for k, v in params.items()]
+        return '{}\n{}\n'.format('\t'.join(fields), '\t'.join(HEADERS))
+
+
+    def encode (self, samples):
+        return ''.join('{}\t{:.2f}\t{:.4f}\t{}\t{}\t{}\n'.format(
+            *sample_row(_)) for _ in samples)
+
+
+class BinaryFormat (object):
+    ''' :data:`MAGIC`, a little-endian uint32 header length, a JSON header
+        and then one packed :data:`RECORD` per sample. The records can be
+        read with ``np.fromfile`` using the dtype in the header, and
+        ``util/teensylog.py`` loads them like its own logs.
+    '''
+
+    extension = '.crec'
+    binary = True
+
+    def header (self, date, params):
+        header = json.dumps({
+            'date': date,
+            'params': params,
+            'columns': HEADERS,
+            'dtype': [['On', '|u1'], ['T', '<f4'], ['Output', '<f4'],
+                      ['dt', '<u2'], ['cycle', '<u4'], ['t', '<u4']],
+        }).encode('utf-8')
+        return MAGIC + struct.pack('<I', len(header)) + header
+
+
+    def encode (self, samples):
+        return b''.join(RECORD.pack(*sample_row(_)) for _ in samples)
+
+
+FORMATS = {
+    'log': LogFormat,
+    'binary': BinaryFormat,
+}
+
+
+class Recorder (object):
+    ''' Writes ``(t, status)`` samples from a background thread.
+
+    :meth:`add` only puts the sample on a queue, so a slow disk never
+    stalls the caller. The writer thread writes samples in batches and
+    starts a new file once the current one exceeds `max_bytes` or is older
+    than `max_age` seconds. Rotated files get a ``.1``, ``.2`` ... suffix
+    before the extension.
+
+    :param path: Output file, the format's extension is added when missing.
+    :param format: ``log`` or ``binary``.
+    :param params: Written to each file header, like ``Kp`` and ``Ki``.
+    :param batch: Maximum samples per write.
+    :param flush_interval: Seconds a sample may wait for its batch.
+    '''
+
+    def __init__ (self, path, format='log', params=None, max_bytes=None,
+                  max_age=None, batch=256, flush_interval=0.5):
+        self.format = FORMATS[format]()
+        root, ext = os.path.splitext(path)
+        if ext != self.format.extension:
+            root, ext = path, self.format.extension
+        self.root = root
+        self.ext = ext
+        self.params = params or {}
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.batch = batch
+        self.flush_interval = flush_interval
+
+        self.files = []
+        self.samples = 0
+        self.start = time.monotonic()
+        self.queue = queue.SimpleQueue()
+        self.fp = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+
+    def add (self, status, t=None):
+        ''' Queues `status` taken at `t`, by default the milliseconds since
+            the recorder was created.
+        '''
+        self.check()
+        if t is None:
+            t = 1000 * (time.monotonic() - self.start)
+        self.queue.put((t, status))
+
+
+    def close (self):
+        ''' Writes the queued samples and closes the file. '''
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+    def check (self):
+        ''' Raises :class:`RecorderError` once the writer thread failed. '''
+        if self.error is not None:
+            raise RecorderError('Recording to {} failed: {}'.format(
+                self.files[-1] if self.files else self.root,
+                self.error)) from self.error
+
+
+    def open (self):
+        if len(self.files) == 0:
+            path = self.root + self.ext
+        else:
+            path = '{}.{}{}'.format(self.root, len(self.files), self.ext)
+
+        mode = 'wb' if self.format.binary else 'w'
+        self.fp = open(path, mode, buffering=1 << 16)
+        self.opened = time.monotonic()
+        self.files.append(path)
+        self.fp.write(self.format.header(
+            time.strftime('%Y-%m-%d %H:%M:%S'), self.params))
+
+
+    def rotate_due (self):
+        if self.max_bytes is not None and self.fp.tell() >= self.max_bytes:
+            return True
+        return self.max_age is not None and \
+            time.monotonic() - self.opened >= self.max_age
+
+
+    def run (self):
+        try:
+            self.write_samples()
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+
+    def write_samples (self):
+        done = False
+
+        while not done:
+            samples = []
+            deadline = None
+
+            while len(samples) < self.batch:
+                timeout = None if deadline is None else \
+                    max(0, deadline - time.monotonic())
+                try:
+                    sample = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if sample is None:
+                    done = True
+                    break
+
+                samples.append(sample)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if samples:
+                if self.fp is None:
+                    self.open()
+                elif self.rotate_due():
+                    self.fp.close()
+                    self.open()
+
+                self.fp.write(self.format.encode(samples))
+                self.samples += len(samples)
@@ -0,0 +1,137 @@
+'''
+    coffee.stats
+    ~~~~~~~~~~~~
+    Channel instrumentation.
+'''
+
+import bisect
+import collections
+
+
+#: Upper bounds of the latency histogram buckets in seconds, the last
+#: bucket collects everything slower.
+LATENCY_BUCKETS = [
+    0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0]
+
+
+class Histogram (object):
+    ''' Counts samples per bucket of :data:`LATENCY_BUCKETS`. '''
+
+    def __init__ (self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add (self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+    @property
+    def mean (self):
+        return self.total / self.count if self.count else 0.0
+
+
+    def percentile (self, fraction):
+        ''' Returns the upper bound of the bucket holding the `fraction`
+            quantile, the maximum for the overflow bucket.
+        '''
+        if not self.count:
+            return 0.0
+
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+        return self.max
+
+
+class CommandStats (object):
+
+    def __init__ (self):
+        self.latency = Histogram()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+        self.decode_errors = 0
+        self.unsupported = 0
+
+
+class ChannelStats (object):
+    ''' Collects per-command round trip latencies, byte counts, timeouts
+        and decode failures. Assign it to ``Channel.stats`` to enable it.
+    '''
+
+    def __init__ (self):
+        self.commands = collections.defaultdict(CommandStats)
+
+
+    def __getitem__ (self, command):
+        return self.commands[int(command)]
+
+
+    def exchange (self, command, sent, received, latency):
+        stats = self[command]
+        stats.bytes_sent += sent
+        stats.bytes_received += received
+        stats.latency.add(latency)
+
+
+    def timeout (self, command, sent):
+        stats = self[command]
+        stats.bytes_sent += sent
+        stats.timeouts += 1
+
+
+    def decode_error (self, command):
+        self[command].decode_errors += 1
+
+
+    def unsupported (self, command):
+        self[command].unsupported += 1
+
+
+    def report (self, names=None):
+        ''' Returns a table with a row per command and its histogram.
+
+        :param names: Optional display names by command byte.
+        '''
+        names = names or {}
+        lines = ['{:<12} {:>7} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9} {:>5} '
+                 '{:>5}'.format('command', 'count', 'mean ms', 'p50 ms',
+                                'p99 ms', 'max ms', 'sent', 'received',
+                                'tmo', 'err')]
+
+        for command in sorted(self.commands):
+            stats = self.commands[command]
+            latency = stats.latency
+            lines.append('{:<12} {:7d} {:8.2f} {:8.2f} {:8.2f} {:8.2f} '
+                         '{:9d} {:9d} {:5d} {:5d}'.format(
+                names.get(command, str(command)), latency.count,
+                1000 * latency.mean, 1000 * latency.percentile(0.5),
+                1000 * latency.percentile(0.99), 1000 * latency.max,
+                stats.bytes_sent, stats.bytes_received, stats.timeouts,
+                stats.decode_errors + stats.unsupported))
+
+        for command in sorted(self.commands):
+            latency = self.commands[command].latency
+            if not latency.count:
+                continue
+
+            lines.append('')
+            lines.append('{} latency'.format(names.get(command, command)))
+            bounds = ['<={:g}'.format(1000 * _) for _ in latency.bounds]
+            bounds.append('>{:g}'.format(1000 * latency.bounds[-1]))
+            peak = max(latency.counts)
+            for bound, count in zip(bounds, latency.counts):
+                if count:
+                    lines.append('  {:>8} ms {:7d} {}'.format(
+                        bound, count, '#' * max(1, 40 * count // peak)))
+
+        return '\n'.join(lines)
@@ -3,10 +3,17 @@
     ~~~~~~~~~~~~
 '''
 
+import asyncio
+import io
+import os
 import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from coffee import channel
+from coffee import channel, daemon, link, message, output, recorder, stats
 
 class TestExpandFormatString (unittest.TestCase):
 
@@ -104,6 +111,35 @@ class TestUnpackMessage (unittest.TestCase):
             self.assertEqual(v, rv[k])
         
 
+class TestCodec (unittest.TestCase):
+
+    def test_codec_matches_unpack_message (self):
+        fields = [
+            ('H', 'label1'),
+            ('B', 'label2'),
+            ('F', 'label3'),
+            ('B', 'label4')
+        ]
+        codec = channel.Codec('BBBBBBB', fields)
+        response = struct.pack('!BHBBBBB', 16, 1, 2, 42, 15, 100, 0)
+
+        expect = channel.unpack_message(fields,
+            struct.unpack(channel.generate_input_format(fields), response)[1:])
+        self.assertEqual(codec.decode(response), expect)
+
+
+    def test_codec_is_cached_per_message_class (self):
+        message = MockMessage()
+        message.format = 'BBBBBBB'
+        message.fields = [('B', 'label1')]
+
+        codec = channel.get_codec(message)
+        self.assertIs(codec, channel.get_codec(message))
+
+        message.fields = [('H', 'label1')]
+        self.assertIsNot(codec, channel.get_codec(message))
+
+
 class MockChannel (channel.Channel):
 
     def __init__ (self):
@@ -113,6 +149,168 @@ class MockChannel (channel.Channel):
         self.written.append(packed)
 
 
+class TestStatusStream (unittest.TestCase):
+
+    def test_stream_yields_records (self):
+        fake = channel.FakeChannel()
+        fake.status['temp'] = 93.0
+
+        with fake.stream(message.SubscribeMessage(50)) as stream:
+            records = []
+            for record in stream:
+                records.append(record)
+                if len(records) == 3:
+                    break
+
+        self.assertEqual([r['temp'] for r in records], [93.0] * 3)
+        self.assertIn('millis', records[0])
+        self.assertEqual(fake.interval, 0)
+
+
+    def test_stream_resyncs_on_noise (self):
+        payload = bytes(20)
+        record = channel.pack_frame(4, payload)
+        noise = bytes([channel.FRAME_SYNC, 4, 3, 1, 2]) + bytes(8)
+
+        mock = LegacyChannel()
+        mock.pending = noise + record + channel.pack_frame(5, b'')
+        stream = channel.StatusStream(mock, message.SubscribeMessage(50))
+
+        self.assertEqual(stream.read_frame(), record[1:-1])
+        self.assertEqual(stream.read_frame(), bytes([5, 0]))
+        self.assertIsNone(stream.read_frame())
+
+
+    def test_stream_on_legacy_firmware (self):
+        legacy = LegacyChannel()
+        stream = legacy.stream(message.SubscribeMessage(50))
+        self.assertRaises(channel.UnsupportedCommand, stream.__enter__)
+
+
+class FakePort (object):
+    ''' Serial port look-alike on top of a :class:`FakeChannel`. '''
+
+    def __init__ (self, chan):
+        self.chan = chan
+
+    def write (self, packed):
+        self.chan.send(packed)
+
+    def read (self, size):
+        data = self.chan.receive(size)
+        if not data:
+            time.sleep(0.001)
+        return data
+
+
+class TestAsyncSerialChannel (unittest.TestCase):
+
+    def run_async (self, coro):
+        return asyncio.run(coro)
+
+
+    def test_pipelined_dispatch (self):
+        fake = channel.FakeChannel()
+        expect = {}
+        for msg in [
+                message.Status1Message(),
+                message.Status2Message(),
+                message.Status3Message()]:
+            expect.update(fake.dispatch(msg))
+
+        async def pipelined ():
+            async with channel.AsyncSerialChannel(FakePort(fake)) as chan:
+                return await asyncio.gather(
+                    chan.dispatch(message.Status1Message()),
+                    chan.dispatch(message.Status2Message()),
+                    chan.dispatch(message.Status3Message()),
+                    chan.dispatch(message.FullStatusMessage()))
+
+        *parts, full = self.run_async(pipelined())
+        rv = {}
+        for part in parts:
+            rv.update(part)
+
+        self.assertEqual(rv['temp'], expect['temp'])
+        self.assertEqual(rv['power'], expect['power'])
+        self.assertEqual(full['temp'], expect['temp'])
+
+
+    def test_dispatch_timeout (self):
+        legacy = LegacyChannel()
+        legacy.pending = b''
+
+        class SilentPort (FakePort):
+            def write (self, packed):
+                pass
+
+        async def silent ():
+            async with channel.AsyncSerialChannel(SilentPort(legacy)) as chan:
+                await chan.dispatch(message.Status1Message(), timeout=0.05)
+
+        self.assertRaises(asyncio.TimeoutError, self.run_async, silent())
+
+
+    def test_lost_response (self):
+        fake = channel.FakeChannel()
+
+        class LossyPort (FakePort):
+            dropped = False
+
+            def write (self, packed):
+                if not self.dropped:
+                    self.dropped = True
+                    return
+                super().write(packed)
+
+        async def requests ():
+            results = []
+            async with channel.AsyncSerialChannel(LossyPort(fake)) as chan:
+                for _ in range(4):
+                    try:
+                        results.append(await chan.dispatch(
+                            message.Status2Message(), timeout=0.05))
+                    except asyncio.TimeoutError:
+                        results.append(None)
+                return results, len(chan.pending[2])
+
+        results, pending = self.run_async(requests())
+        self.assertIsNone(results[0])
+        # The next response may go to the discard marker, not any later.
+        self.assertTrue(all(results[2:]))
+        self.assertAlmostEqual(results[3]['temp'], fake.status['temp'],
+                               delta=0.01)
+        self.assertEqual(pending, 0)
+
+
+    def test_resync_on_unknown_byte (self):
+        fake = channel.FakeChannel()
+
+        class NoisyPort (FakePort):
+            def write (self, packed):
+                fake.retval += b'\xff'
+                super().write(packed)
+
+        async def request ():
+            async with channel.AsyncSerialChannel(NoisyPort(fake)) as chan:
+                return await chan.dispatch(message.Status2Message(),
+                                           timeout=0.5)
+
+        self.assertAlmostEqual(self.run_async(request())['temp'],
+                               fake.status['temp'], delta=0.01)
+
+
+class LegacyChannel (MockChannel):
+    ''' Answers like firmware that doesn't know the command. '''
+
+    def send (self, packed):
+        self.pending = struct.pack('!BBBBBBBB', packed[0], 0, 0, 0, 0, 0, 0, 0)
+
+    def receive (self, size=8):
+        retval, self.pending = self.pending[:size], self.pending[size:]
+        return retval
+
+
 class MockMessage (object):
     pass
 
@@ -152,6 +350,379 @@ class TestChannel (unittest.TestCase):
 
 
 
+class TestChannelStats (unittest.TestCase):
+
+    def setUp (self):
+        self.channel = channel.FakeChannel()
+        self.channel.stats = stats.ChannelStats()
+
+
+    def test_dispatch_is_recorded (self):
+        self.channel.dispatch(message.Status1Message())
+        self.channel.dispatch(message.FullStatusMessage())
+
+        status1 = self.channel.stats[message.CommandType.Status1]
+        self.assertEqual(status1.latency.count, 1)
+        self.assertEqual(status1.bytes_sent, 8)
+        self.assertEqual(status1.bytes_received, 8)
+        self.assertEqual(
+            self.channel.stats[message.CommandType.FullStatus].bytes_received,
+            18)
+        self.assertIn('FullStatus', self.channel.stats.report(
+            {int(_): _.name for _ in message.CommandType}))
+
+
+    def test_short_read_is_a_timeout (self):
+        self.channel.receive = lambda size=8: b'\x01\x00'
+
+        self.assertRaises(channel.ReadTimeout,
+            self.channel.dispatch, message.Status1Message())
+        status1 = self.channel.stats[message.CommandType.Status1]
+        self.assertEqual(status1.timeouts, 1)
+        self.assertEqual(status1.latency.count, 0)
+
+
+    def test_histogram_percentile (self):
+        histogram = stats.Histogram()
+        for value in [0.0001] * 98 + [0.03, 2.0]:
+            histogram.add(value)
+
+        self.assertEqual(histogram.percentile(0.5), 0.0005)
+        self.assertEqual(histogram.percentile(0.99), 0.05)
+        self.assertEqual(histogram.percentile(1), 2.0)
+
+
+class FramedDevice (channel.Channel):
+    ''' Answers framed requests with the :class:`channel.FakeChannel`
+        responses, `faults` is applied to the successive response frames.
+    '''
+
+    def __init__ (self, faults=()):
+        self.device = channel.FakeChannel()
+        self.faults = list(faults)
+        self.pending = b''
+        self.requests = []
+
+
+    def send (self, frame):
+        sequence = frame[1]
+        request = frame[3:11]
+        self.requests.append(sequence)
+        self.device.send(request)
+        response = channel.pack_framed(sequence, self.device.retval)
+        self.device.retval = b''
+
+        fault = self.faults.pop(0) if self.faults else None
+        if fault == 'drop':
+            return
+        elif fault == 'corrupt':
+            response = response[:4] + bytes([response[4] ^ 1]) + response[5:]
+        elif fault == 'stale':
+            response = channel.pack_framed((sequence - 1) & 0xff,
+                                           b'\x01' * 8) + response
+        self.pending += b'\x00\x7e' + response
+
+
+    def receive (self, size=8):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+class TestFramedChannel (unittest.TestCase):
+
+    def test_dispatch (self):
+        framed = channel.FramedChannel(FramedDevice(), timeout=0.01)
+        status = framed.dispatch(message.FullStatusMessage())
+        self.assertAlmostEqual(status['temp'], 21.25, places=1)
+        self.assertEqual(framed.retransmits, 0)
+
+
+    def test_corrupt_response_is_retried (self):
+        device = FramedDevice(['corrupt'])
+        framed = channel.FramedChannel(device, timeout=0.01)
+        status = framed.dispatch(message.Status1Message())
+
+        self.assertIn('heater_on', status)
+        self.assertGreater(framed.crc_errors, 0)
+        self.assertEqual(framed.retransmits, 1)
+        # The retry reuses the sequence number.
+        self.assertEqual(device.requests, [1, 1])
+
+
+    def test_stale_response_is_discarded (self):
+        framed = channel.FramedChannel(FramedDevice(['stale']), timeout=0.01)
+        status = framed.dispatch(message.Status3Message())
+
+        self.assertAlmostEqual(status['power'], 0.42, places=2)
+        self.assertEqual(framed.stale, 1)
+        self.assertEqual(framed.retransmits, 0)
+
+
+    def test_gives_up_after_retries (self):
+        framed = channel.FramedChannel(FramedDevice(['drop'] * 3),
+                                       retries=2, timeout=0.01)
+        self.assertRaises(channel.ReadTimeout,
+            framed.dispatch, message.Status1Message())
+        self.assertEqual(framed.retransmits, 2)
+
+
+class BaudPort (object):
+
+    def __init__ (self):
+        self.baudrate = link.DEFAULT_BAUD
+
+
+    def reset_input_buffer (self):
+        pass
+
+
+class BaudChannel (MockChannel):
+    ''' Accepts baud rate changes, `confirm` is whether requests at the new
+        rate get through.
+    '''
+
+    def __init__ (self, port, confirm):
+        super().__init__()
+        self.port = port
+        self.confirm = confirm
+        self.pending = b''
+
+
+    def send (self, packed):
+        super().send(packed)
+        if packed[0] == message.CommandType.Baud:
+            self.pending = bytes([packed[0], 1]) + packed[1:5] + b'\x00\x00'
+        elif self.confirm or self.port.baudrate == link.DEFAULT_BAUD:
+            self.pending = packed
+
+
+    def receive (self, size=8):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+class TestNegotiateBaud (unittest.TestCase):
+
+    def setUp (self):
+        self.timeout = link.BAUD_CONFIRM_TIMEOUT
+        link.BAUD_CONFIRM_TIMEOUT = 0
+
+
+    def tearDown (self):
+        link.BAUD_CONFIRM_TIMEOUT = self.timeout
+
+
+    def test_switch (self):
+        port = BaudPort()
+        chan = BaudChannel(port, confirm=True)
+        self.assertEqual(link.negotiate_baud(chan, port, 115200), 115200)
+        self.assertEqual(port.baudrate, 115200)
+        self.assertEqual(struct.unpack('!L', chan.written[0][1:5]),
+                         (115200,))
+
+
+    def test_revert_without_confirmation (self):
+        port = BaudPort()
+        chan = BaudChannel(port, confirm=False)
+        self.assertEqual(link.negotiate_baud(chan, port, 115200, attempts=1),
+                         link.DEFAULT_BAUD)
+        self.assertEqual(port.baudrate, link.DEFAULT_BAUD)
+
+
+class TestDaemon (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'coffee.sock')
+        self.device = channel.FakeChannel()
+        self.server = daemon.Daemon(path, self.device, freshness=60)
+        threading.Thread(target=self.server.serve_forever,
+                         kwargs={'poll_interval': 0.01}, daemon=True).start()
+        self.client = daemon.DaemonChannel(path)
+
+
+    def tearDown (self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+
+    def test_status_is_cached (self):
+        first = self.client.dispatch(message.FullStatusMessage())
+        self.device.status['temp'] = 50.0
+        second = self.client.dispatch(message.FullStatusMessage())
+
+        self.assertEqual(first, second)
+        self.assertEqual((self.server.hits, self.server.misses), (1, 1))
+
+
+    def test_commands_invalidate_the_cache (self):
+        self.client.dispatch(message.Status2Message())
+        self.device.status['temp'] = 50.0
+        self.client.dispatch(message.StartPumpMessage(1000))
+
+        status = self.client.dispatch(message.Status2Message())
+        self.assertEqual(status['temp'], 50.0)
+
+
+    def test_link_commands_are_refused (self):
+        self.assertRaises(channel.UnsupportedCommand,
+            self.client.dispatch, message.SubscribeMessage(100))
+
+
+class TestFullStatus (unittest.TestCase):
+
+    def test_full_status_matches_status_messages (self):
+        fake = channel.FakeChannel()
+        expect = {}
+        for msg in [
+                message.Status1Message(),
+                message.Status2Message(),
+                message.Status3Message()]:
+            expect.update(fake.dispatch(msg))
+
+        rv = fake.dispatch(message.FullStatusMessage())
+        self.assertEqual(set(rv), set(expect))
+        self.assertEqual(rv['temp'], expect['temp'])
+        self.assertEqual(rv['power'], expect['power'])
+
+
+    def test_full_status_on_legacy_firmware (self):
+        legacy = LegacyChannel()
+        self.assertRaises(channel.UnsupportedCommand,
+            legacy.dispatch, message.FullStatusMessage())
+        self.assertEqual(legacy.pending, b'')
+
+class TestOutput (unittest.TestCase):
+
+    def test_window_width_is_cached (self):
+        geometry = output.TerminalGeometry(max_age=60)
+        geometry.installed = True
+        width = geometry.columns
+        geometry.size = os.terminal_size((width + 1, geometry.size.lines))
+        self.assertEqual(geometry.columns, width + 1)
+
+        geometry.on_resize(None, None)
+        self.assertEqual(geometry.columns, width)
+
+
+    def test_progress_is_rate_limited (self):
+        fp = io.StringIO()
+        progress = output.Progress(10, fp=fp, fps=1)
+        progress.update(1)
+        written = fp.tell()
+
+        progress.update(2)
+        self.assertEqual(fp.tell(), written)
+
+        progress.finish()
+        self.assertGreater(fp.tell(), written)
+
+
+    def test_unchanged_frame_is_not_written (self):
+        fp = io.StringIO()
+        progress = output.Progress(10, fp=fp, fps=0)
+        progress.update(1)
+        written = fp.tell()
+
+        progress.update(1.001)
+        self.assertEqual(fp.tell(), written)
+
+        progress.update(5)
+        self.assertGreater(fp.tell(), written)
+
+
+class TestRecorder (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'record')
+        self.status = channel.FakeChannel().dispatch(
+            message.FullStatusMessage())
+
+
+    def tearDown (self):
+        self.directory.cleanup()
+
+
+    def test_log_format (self):
+        with recorder.Recorder(self.path, params={'Kp': 0.05}) as rec:
+            rec.add(self.status, t=10)
+            rec.add(self.status, t=20)
+
+        self.assertEqual(rec.files, [self.path + '.log'])
+        with open(rec.files[0]) as fp:
+            lines = fp.read().splitlines()
+
+        self.assertTrue(lines[0].endswith('\tKp=0.05'))
+        self.assertEqual(lines[1].split('\t'), recorder.HEADERS)
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[3].split('\t')[-1], '20')
+
+
+    def test_binary_format (self):
+        with recorder.Recorder(self.path, 'binary') as rec:
+            for t in range(5):
+                rec.add(self.status, t=t)
+
+        with open(rec.files[0], 'rb') as fp:
+            data = fp.read()
+
+        self.assertTrue(data.startswith(recorder.MAGIC))
+        size, = struct.unpack('<I', data[8:12])
+        records = data[12 + size:]
+        self.assertEqual(len(records), 5 * recorder.RECORD.size)
+        row = recorder.RECORD.unpack_from(records, 4 * recorder.RECORD.size)
+        self.assertEqual(row[-1], 4)
+        self.assertAlmostEqual(row[1], self.status['temp'], places=4)
+
+
+    def test_binary_round_trip (self):
+        sys.path.insert(0, os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..', 'util'))
+        try:
+            import teensylog
+        finally:
+            del sys.path[0]
+
+        with recorder.Recorder(self.path, 'binary',
+                               params={'Kp': 0.05}) as rec:
+            for t in range(0, 5000, 1000):
+                rec.add(self.status, t=t)
+
+        params, data = teensylog.load(rec.files[0], ['t', 'T'],
+                                      t_range=(1000, 4000))
+        self.assertEqual(params, {'Kp': 0.05})
+        self.assertEqual(list(data['t']), [1000, 2000, 3000])
+        self.assertAlmostEqual(float(data['T'][0]), self.status['temp'],
+                               places=4)
+
+
+    def test_rotate_by_size (self):
+        rec = recorder.Recorder(self.path, max_bytes=1, batch=1)
+        for t in range(3):
+            rec.add(self.status, t=t)
+        rec.close()
+
+        self.assertEqual(rec.files, [
+            self.path + '.log', self.path + '.1.log', self.path + '.2.log'])
+        self.assertEqual(rec.samples, 3)
+
+
+    def test_writer_error (self):
+        rec = recorder.Recorder(self.path, batch=1)
+
+        def encode (samples):
+            raise KeyError('temp')
+        rec.format.encode = encode
+
+        rec.add(self.status, t=0)
+        rec.thread.join(1)
+        self.assertIsInstance(rec.error, KeyError)
+        self.assertRaises(recorder.RecorderError, rec.add, self.status)
+        self.assertRaises(recorder.RecorderError, rec.close)
+        self.assertEqual(rec.samples, 0)
 
 
 if __name__ == '__main__':
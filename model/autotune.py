@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+'''
+    Autotune
+    ~~~~~~~~
+    Fits the PID gains, and optionally the thermal parameters of
+    :mod:`system`, to recorded teensy logs.
+
+    Every log is a scenario: its start temperature, setpoint, cycle and
+    duration, and the gains it was recorded with. With ``--plant`` the
+    ``Rf``, ``Re`` and ``Cw`` are fitted first, so that simulating each log
+    with its own gains reproduces the recorded ``Tm``. The gains are then
+    tuned on that plant for the lowest tracking error, the RMS of
+    ``setpoint - Tm`` over all scenarios.
+
+    Both fits are a cross-entropy search: every generation draws a
+    population of candidates around the current estimate, evaluates them
+    as one batched :func:`sweep.sweep` per scenario, split over worker
+    processes, and moves the estimate to the best of them.
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import os.path
+import sys
+import time
+
+import numpy as np
+
+import simulate
+import sweep
+import system
+
+
+GAINS = ('Kp', 'Ki', 'Kd')
+PLANT = ('Rf', 'Re', 'Cw')
+
+#: Initial search spread of the gains.
+GAIN_SPREAD = (0.05, 0.0005, 1.0)
+
+#: Initial search spread of the plant, relative to the start values.
+PLANT_SPREAD = 0.3
+
+#: A recorded run, `t` and `Tm` are the log resampled to the sweep output.
+Scenario = collections.namedtuple('Scenario', [
+    'name', 'setpoint', 'Kp', 'Ki', 'Kd', 'dt', 'horizon', 'T0', 't', 'Tm'])
+
+
+def load_scenario(path, horizon=7200, resolution=1.0, setpoint=100,
+                  cycle=500):
+    ''' Returns the :class:`Scenario` of the log at `path`. Parameters
+        missing in the log header come from the arguments, a missing ``Kp``
+        is None and missing ``Ki`` and ``Kd`` are 0.
+    '''
+    params, t, T = simulate.load_log(path, horizon)
+    if len(t) < 2:
+        raise ValueError('{}: not enough samples'.format(path))
+
+    t = t - t[0]
+    dt = float(params.get('cycle', cycle)) / 1000
+    resolution = max(1, int(round(resolution / dt))) * dt
+    grid = np.arange(0, t[-1], resolution)
+    if len(grid) < 2:
+        raise ValueError('{}: not enough samples'.format(path))
+
+    return Scenario(
+        name=os.path.basename(path),
+        setpoint=float(params.get('setpoint', setpoint)),
+        Kp=float(params['Kp']) if 'Kp' in params else None,
+        Ki=float(params.get('Ki', 0)),
+        Kd=float(params.get('Kd', 0)),
+        dt=dt,
+        horizon=len(grid) * resolution,
+        T0=float(T[0]),
+        t=grid,
+        Tm=np.interp(grid, t, T))
+
+
+def simulate_scenario(scenario, Kp, Ki, Kd, plant=None):
+    ''' Returns ``Tm`` on the scenario's grid for every configuration. '''
+    result = sweep.sweep(Kp, Ki, Kd, scenario.setpoint,
+                         horizon=scenario.horizon, dt=scenario.dt,
+                         y0=(scenario.T0, scenario.T0),
+                         record=scenario.t[1] - scenario.t[0],
+                         product=False, plant=plant)
+    return result['Tm'][:, :len(scenario.t)]
+
+
+def rms(error):
+    return np.sqrt(np.mean(error ** 2, axis=-1))
+
+
+def tracking_costs(gains, scenarios, plant=None):
+    ''' Mean tracking error of the ``(N, 3)`` `gains` over `scenarios`. '''
+    costs = np.zeros(len(gains))
+    for scenario in scenarios:
+        Tm = simulate_scenario(scenario, *gains.T, plant=plant)
+        costs += rms(scenario.setpoint - Tm)
+    return costs / len(scenarios)
+
+
+def model_costs(plants, scenarios):
+    ''' Mean error between the recorded and simulated ``Tm`` of the
+        ``(N, 3)`` `plants` over `scenarios`.
+    '''
+    costs = np.zeros(len(plants))
+    plant = dict(zip(PLANT, plants.T))
+    for scenario in scenarios:
+        Tm = simulate_scenario(scenario, scenario.Kp, scenario.Ki,
+                               scenario.Kd, plant)
+        costs += rms(scenario.Tm - Tm)
+    return costs / len(scenarios)
+
+
+def parallel(costs, executor, workers):
+    ''' Returns `costs` evaluated in chunks on `executor`. '''
+    if executor is None:
+        return costs
+
+    def evaluate(candidates):
+        chunks = np.array_split(candidates, min(workers, len(candidates)))
+        return np.concatenate(list(executor.map(costs, chunks)))
+
+    return evaluate
+
+
+def cross_entropy(costs, mean, spread, lower, generations=20, population=64,
+                  elite=8, seed=0, report=None):
+    ''' Minimizes `costs` over parameter vectors.
+
+    :param costs: Maps an ``(N, K)`` array of candidates to ``N`` costs.
+    :param mean: The start values, also the first best candidate.
+    :param spread: Initial standard deviation per parameter, zero keeps a
+                   parameter fixed.
+    :param lower: Lower bounds, candidates are clipped to them.
+    :param report: Called with ``(generation, best, cost)``.
+
+    :returns: ``(best, cost)``.
+    '''
+    rng = np.random.default_rng(seed)
+    mean = np.asarray(mean, dtype=float)
+    spread = np.asarray(spread, dtype=float)
+    best, best_cost = mean, costs(mean[None])[0]
+
+    for generation in range(generations):
+        candidates = rng.normal(mean, spread, (population, len(mean)))
+        candidates[0] = best
+        np.maximum(candidates, lower, out=candidates)
+
+        values = costs(candidates)
+        order = np.argsort(values)[:elite]
+        if values[order[0]] < best_cost:
+            best, best_cost = candidates[order[0]], values[order[0]]
+
+        mean = candidates[order].mean(axis=0)
+        spread = 0.5 * spread + 0.5 * candidates[order].std(axis=0)
+
+        if report:
+            report(generation, best, best_cost)
+
+    return best, best_cost
+
+
+def overshoot(scenario, Tm):
+    return max(0.0, float(np.max(Tm)) - scenario.setpoint)
+
+
+def fit_report(scenarios, gains, plant=None):
+    ''' Returns a table comparing every recorded run with the simulation
+        of its own gains and with the tuned `gains`.
+    '''
+    lines = ['{:<32} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'log', 'setpoint', 'model', 'rec rms', 'tuned', 'rec over',
+        'tuned over')]
+
+    for scenario in scenarios:
+        model = float('nan')
+        if scenario.Kp is not None:
+            Tm = simulate_scenario(scenario, scenario.Kp, scenario.Ki,
+                                   scenario.Kd, plant)[0]
+            model = rms(scenario.Tm - Tm)
+
+        tuned = simulate_scenario(scenario, *gains, plant=plant)[0]
+        lines.append('{:<32} {:8.1f} {:9.3f} {:9.3f} {:9.3f} {:9.2f} '
+                     '{:9.2f}'.format(
+                         scenario.name[:32], scenario.setpoint, model,
+                         rms(scenario.setpoint - scenario.Tm),
+                         rms(scenario.setpoint - tuned),
+                         overshoot(scenario, scenario.Tm),
+                         overshoot(scenario, tuned)))
+
+    lines.append('')
+    lines.append('model: RMS of recorded - simulated Tm with the logged '
+                 'gains; rms: RMS of setpoint - Tm;')
+    lines.append('over: overshoot in degrees.')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fits PID gains and optionally Rf/Re/Cw to teensy logs.')
+    parser.add_argument('logs', nargs='+', help='.log, .tlog or .crec files.')
+    parser.add_argument('--plant', action='store_true',
+                        help='Fit Rf, Re and Cw to the logs first.')
+    parser.add_argument('--fixed', default='',
+                        help='Comma separated gains to keep, e.g. Kd.')
+    parser.add_argument('--kp', type=float, default=None,
+                        help='Start values, default to the first log.')
+    parser.add_argument('--ki', type=float, default=None)
+    parser.add_argument('--kd', type=float, default=None)
+    parser.add_argument('--setpoint', type=float, default=100,
+                        help='For logs without a setpoint.')
+    parser.add_argument('--horizon', type=float, default=7200,
+                        help='Use at most this many seconds of every log.')
+    parser.add_argument('--resolution', type=float, default=1.0,
+                        help='Seconds between compared samples.')
+    parser.add_argument('-g', '--generations', type=int, default=20)
+    parser.add_argument('-p', '--population', type=int, default=64)
+    parser.add_argument('--elite', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    scenarios = [load_scenario(_, args.horizon, args.resolution,
+                               args.setpoint) for _ in args.logs]
+    fixed = {_.strip().lower() for _ in args.fixed.split(',') if _.strip()}
+    start = time.perf_counter()
+
+    def progress(label):
+        def report(generation, best, cost):
+            print('{} {:3d}: {} cost {:.4f}'.format(
+                label, generation + 1,
+                ' '.join('{:.5g}'.format(_) for _ in best), cost))
+            sys.stdout.flush()
+        return report
+
+    executor = None
+    if args.workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(args.workers)
+
+    try:
+        plant = None
+        if args.plant:
+            recorded = [_ for _ in scenarios if _.Kp is not None]
+            if not recorded:
+                print('--plant needs logs with their Kp in the header')
+                return -1
+
+            values = np.array([getattr(system, _) for _ in PLANT])
+            best, cost = cross_entropy(
+                parallel(functools.partial(model_costs, scenarios=recorded),
+                         executor, args.workers),
+                values, PLANT_SPREAD * values, 0.05 * values,
+                args.generations, args.population, args.elite, args.seed,
+                progress('plant'))
+            plant = dict(zip(PLANT, best))
+
+        first = scenarios[0]
+        mean = [_ if _ is not None else default for _, default in zip(
+            (args.kp, args.ki, args.kd),
+            (0.05 if first.Kp is None else first.Kp, first.Ki, first.Kd))]
+        spread = [0 if name.lower() in fixed else value
+                  for name, value in zip(GAINS, GAIN_SPREAD)]
+
+        gains, cost = cross_entropy(
+            parallel(functools.partial(tracking_costs, scenarios=scenarios,
+                                       plant=plant),
+                     executor, args.workers),
+            mean, spread, np.zeros(3), args.generations, args.population,
+            args.elite, args.seed, progress('gains'))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = time.perf_counter() - start
+
+    print()
+    print('Finished in {:.1f}s'.format(elapsed))
+    if plant:
+        print('Plant: ' + ', '.join('{}={:.5g} (was {:.5g})'.format(
+            name, value, getattr(system, name))
+            for name, value in plant.items()))
+    print('Gains: ' + ', '.join('{}={:.5g}'.format(name, value)
+                                for name, value in zip(GAINS, gains)))
+    print('Tracking error: {:.3f} degrees RMS'.format(cost))
+    print()
+    print(fit_report(scenarios, gains, plant))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+    Solver benchmark
+    ~~~~~~~~~~~~~~~~
+    Times the ``odeint`` and ``zvode`` paths on :func:`system.model` against
+    ``odeint`` on :class:`system.System` and the ``vode`` and ``lsoda``
+    paths with its closed-loop Jacobian, for the PID and threshold
+    controllers. Differences are relative to the ``vode`` result,
+    ``odeint`` gives up on the bang-bang threshold controller and leaves
+    the remaining rows at zero; ``lsoda`` gets through it but takes
+    millions of evaluations.
+'''
+
+import argparse
+import functools
+import sys
+import time
+
+import numpy as np
+from scipy.integrate import odeint
+
+import simulation
+import system
+
+
+def reference(controller, t, y0):
+    ''' ``odeint`` on :func:`system.model` without a Jacobian. '''
+    model = functools.partial(system.model, controller)
+    return odeint(model, list(y0), t)
+
+
+def legacy_bdf(controller, t, y0):
+    return simulation.odebdf(functools.partial(system.model, controller),
+                             list(y0), t)
+
+
+SOLVERS = [
+    ('odeint (model)', reference),
+    ('bdf (zvode)', legacy_bdf),
+    ('odeint (System)',
+     functools.partial(simulation.simulate, solver='odeint')),
+    ('vode + jac', functools.partial(simulation.simulate, solver='vode')),
+    ('lsoda + jac', functools.partial(simulation.simulate, solver='lsoda')),
+]
+
+
+def failed(result):
+    return not np.all(np.isfinite(result)) or \
+        np.any(np.all(result[1:] == 0, axis=1))
+
+
+def controllers(setpoint, Kp, Ki, Kd):
+    return [
+        ('pid', lambda: simulation.PidController(setpoint, Kp, Ki, Kd)),
+        ('threshold', lambda: simulation.ThresholdController(setpoint)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kp', type=float, default=0.065)
+    parser.add_argument('--ki', type=float, default=0.0001)
+    parser.add_argument('--kd', type=float, default=0)
+    parser.add_argument('--setpoint', type=float, default=100)
+    parser.add_argument('--horizon', type=float, default=3600,
+                        help='Seconds, the controllers cut power at 3600.')
+    parser.add_argument('--dt', type=float, default=0.05)
+    parser.add_argument('--solvers', default=','.join(_[0] for _ in SOLVERS),
+                        help='Comma separated subset of the solvers.')
+    args = parser.parse_args()
+
+    solvers = [_ for _ in SOLVERS if _[0] in args.solvers.split(',')]
+
+    t = np.arange(0, args.horizon, args.dt)
+    y0 = (20, 20)
+
+    print('{:10} {:16} {:>9} {:>9} {:>10}'.format(
+        'controller', 'solver', 'seconds', 'calls', 'max dTm'))
+
+    for name, create in controllers(args.setpoint, args.kp, args.ki,
+                                    args.kd):
+        baseline = simulation.simulate(create(), t, y0, 'vode')
+        for label, solve in solvers:
+            controller = create()
+            start = time.perf_counter()
+            result = solve(controller, t, y0)
+            elapsed = time.perf_counter() - start
+
+            difference = 'failed' if failed(result) else '{:.4f}'.format(
+                np.max(np.abs(result[:, 1] - baseline[:, 1])))
+            print('{:10} {:16} {:9.3f} {:9d} {:>10}'.format(
+                name, label, elapsed, controller.power.calls, difference))
+            sys.stdout.flush()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
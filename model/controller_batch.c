@@ -0,0 +1,35 @@
+/*
+ * Batch entry point for libcontroller.so, steps many controller contexts
+ * over many time steps in one call so simulations don't pay a ctypes call
+ * per controller evaluation.
+ */
+
+/* Same layout as ControllerContext in simulation.py. */
+typedef struct {
+    float setpoint;
+    float Kp;
+    float Ki;
+    float Kd;
+    float integral;
+    float previous_error;
+} ControllerContext;
+
+float controller_power(ControllerContext *ctx, float dt, float T);
+
+
+/*
+ * Steps `n` contexts over `m` time steps. `T` and `output` are row-major
+ * n by m arrays (one row per context), `dt` holds the m step sizes.
+ */
+void controller_power_batch(ControllerContext *contexts, int n, int m,
+                            const float *dt, const float *T, float *output)
+{
+    int i, j;
+
+    for (i = 0; i < n; i++) {
+        for (j = 0; j < m; j++) {
+            output[i * m + j] = controller_power(&contexts[i], dt[j],
+                                                 T[i * m + j]);
+        }
+    }
+}
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+'''
+    Device
+    ~~~~~~
+    A simulated Silvia that speaks the serial protocol of the teensy
+    firmware. It runs the firmware loop (``Loop.cpp``) and PID controller
+    (``Controller.cpp``) against the thermal model in :mod:`system`, and is
+    exposed through a pseudo-terminal so ``coffee.py -s <pty>`` can talk to
+    it unchanged.
+'''
+
+import argparse
+import binascii
+import collections
+import os
+import select
+import struct
+import sys
+import time
+import tty
+
+import system
+
+
+# -------------------------------------------------------------------------
+# Protocol
+
+COMMAND_STATUS1 = 1
+COMMAND_STATUS2 = 2
+COMMAND_STATUS3 = 3
+COMMAND_STATUS_FULL = 4
+COMMAND_SUBSCRIBE = 5
+COMMAND_FRAMING = 6
+COMMAND_BAUD = 7
+COMMAND_SETPOINT = 10
+COMMAND_START_PUMP = 20
+COMMAND_STOP_PUMP = 21
+
+FRAME_SYNC = 0xA5
+
+FRAME_START = 0x7E
+FRAMING_VERSION = 1
+FRAMED_REQUEST = 13
+REQUEST_TIMEOUT = 50
+
+BAUD = 9600
+BAUD_CONFIRM_TIMEOUT = 1000
+SUPPORTED_BAUD = (9600, 19200, 38400, 57600, 115200, 230400, 460800)
+
+
+def pack_float(f):
+    ''' Same truncation as the firmware's ``PACKF``. '''
+    integer = int(f) & 0xff
+    return integer, int(255 * (f - integer)) & 0xff
+
+
+def write_frame(kind, payload):
+    body = bytes([kind, len(payload)]) + payload
+    checksum = 0
+    for byte in body:
+        checksum ^= byte
+    return bytes([FRAME_SYNC]) + body + bytes([checksum])
+
+
+def crc16(data):
+    ''' CRC-16/CCITT with an initial value of 0xffff, like ``crc16``. '''
+    return binascii.crc_hqx(bytes(data), 0xffff)
+
+
+# -------------------------------------------------------------------------
+# Firmware ports
+
+class PidController(object):
+    ''' Port of ``PidController`` in ``Controller.cpp``. '''
+
+    def __init__(self, setpoint, Kp, Ki=0, Kd=0):
+        self.setpoint = setpoint
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+        self.integral = 0
+        self.previous_error = 0
+
+    def heater_power(self, dt, T):
+        error = self.setpoint - T
+
+        self.integral += error * dt
+        self.integral = min(self.integral, 250)
+
+        derivative = 0 if dt == 0 else (error - self.previous_error) / dt
+        self.previous_error = error
+
+        return self.Kp * error + self.Ki * self.integral + self.Kd * derivative
+
+
+class Boiler(object):
+    ''' The :func:`system.model` thermal system, stepped with the loop tick.
+
+    :param y0: Initial water and metal temperatures.
+    :param resolution: Sensor resolution, the MAX31855 reads in 0.25 steps.
+    '''
+
+    def __init__(self, y0=(system.Te, system.Te), resolution=0.25):
+        self.y = list(y0)
+        self.resolution = resolution
+        self.heater_on = False
+
+    def power(self, t, T):
+        # At T == 140 the second bimetallic thermostat (T2) disconnects
+        if not self.heater_on or T >= 140:
+            return 0
+        return system.heater_power
+
+    def step(self, dt):
+        dy = system.model(self.power, self.y, 0)
+        self.y[0] += dy[0] * dt
+        self.y[1] += dy[1] * dt
+
+    def read_temperature(self):
+        return round(self.y[1] / self.resolution) * self.resolution
+
+
+class Loop(object):
+    ''' Port of ``Loop`` in ``Loop.cpp``, `stream` needs ``available()``,
+        ``read(n)`` and ``write(data)``.
+    '''
+
+    def __init__(self, stream, controller, sensor, full_cycle):
+        self.stream = stream
+        self.controller = controller
+        self.sensor = sensor
+        self.full_cycle = full_cycle
+
+        self.heater_on_cycle = 0
+        self.heater_off_cycle = 0
+        self.dt = 0
+        self.first_call = 0
+        self.last_call = 0
+        self.pump_on_cycle = 0
+        self.last_push = 0
+        self.stream_interval = 0
+        self.temperature = 0.0
+        self.heater_power = 0.0
+        self.heater_on = 0
+        self.pump_on = 0
+        self.rx = bytearray()
+        self.rx_started = 0
+        self.last_sequence = 0
+        self.last_response = b''
+        self.change_baud = None
+        self.baud = 0
+        self.pending_baud = 0
+        self.previous_baud = 0
+        self.baud_deadline = None
+
+    def set_baud_callback(self, callback, current):
+        self.change_baud = callback
+        self.baud = current
+
+    def once(self, now):
+        if self.full_cycle == 0:
+            return
+
+        if self.first_call == 0:
+            self.first_call = now
+            return
+
+        self.set_heater_power(now)
+        self.set_pump_cycle()
+        self.poll_comms(now)
+        self.update_baud(now)
+        self.push_status(now)
+
+    def set_heater_power(self, now):
+        if self.heater_on_cycle > 0:
+            self.heater_on = 1
+            self.heater_on_cycle -= 1
+        elif self.heater_off_cycle > 9:
+            self.heater_on = 0
+            self.heater_off_cycle -= 1
+        else:
+            self.temperature = self.sensor.read_temperature()
+            self.dt = (now - self.last_call) & 0xffff
+            self.last_call = now
+            self.heater_power = self.controller.heater_power(
+                self.dt / 1000.0, self.temperature)
+
+            if self.heater_power >= 1:
+                self.heater_on = 1
+                self.heater_on_cycle = self.full_cycle
+                self.heater_off_cycle = 0
+            elif self.heater_power == 0:
+                self.heater_on = 0
+                self.heater_on_cycle = 0
+                self.heater_off_cycle = self.full_cycle
+            else:
+                # The uint16_t conversion saturates negative power to 0.
+                self.heater_on_cycle = int(
+                    max(0, self.heater_power) * self.full_cycle)
+                self.heater_off_cycle = self.full_cycle - self.heater_on_cycle
+                self.heater_on = 1
+
+    def set_pump_cycle(self):
+        if self.pump_on_cycle > 0:
+            self.pump_on = 1
+            self.pump_on_cycle -= 1
+        else:
+            self.pump_on = 0
+
+    def pack_status(self):
+        return struct.pack(
+            '!HHHBLBBBBB',
+            self.heater_on_cycle, self.heater_off_cycle, self.dt,
+            self.heater_on & 0xff, self.pump_on_cycle,
+            *pack_float(self.temperature), self.pump_on & 0xff,
+            *pack_float(self.heater_power))
+
+    def poll_comms(self, now):
+        rx = self.rx
+        if rx and now - self.rx_started > REQUEST_TIMEOUT:
+            # A byte got lost, drop the partial request to get back in step.
+            del rx[:]
+
+        while self.stream.available() > 0:
+            if not rx:
+                self.rx_started = now
+            rx += self.stream.read(1)
+
+            if rx[0] == FRAME_START:
+                if len(rx) == 3 and rx[2] != 8:
+                    self.resync()
+                elif len(rx) == FRAMED_REQUEST:
+                    self.handle_frame(now)
+                    return
+            elif len(rx) == 8:
+                output = self.handle_command(bytes(rx), now)
+                del rx[:]
+                if output:
+                    self.stream.write(output)
+                return
+
+    def handle_frame(self, now):
+        rx = self.rx
+        crc, = struct.unpack_from('!H', rx, FRAMED_REQUEST - 2)
+        if crc16(rx[1:FRAMED_REQUEST - 2]) != crc:
+            self.resync()
+            return
+
+        sequence = rx[1]
+        request = bytes(rx[3:11])
+        del rx[:]
+
+        # A repeated sequence number is a retry, send the response again.
+        if not self.last_response or sequence != self.last_sequence:
+            self.last_sequence = sequence
+            output = self.handle_command(request, now)
+            self.last_response = b''
+            if not output:
+                return
+            body = bytes([sequence, len(output)]) + output
+            self.last_response = bytes([FRAME_START]) + body + \
+                struct.pack('!H', crc16(body))
+
+        self.stream.write(self.last_response)
+
+    def resync(self):
+        start = self.rx.find(FRAME_START, 1)
+        del self.rx[:start if start > 0 else len(self.rx)]
+
+    def update_baud(self, now):
+        if self.pending_baud:
+            self.previous_baud = self.baud
+            self.baud = self.pending_baud
+            self.pending_baud = 0
+            self.change_baud(self.baud)
+            self.baud_deadline = now + BAUD_CONFIRM_TIMEOUT
+        elif self.baud_deadline is not None and now >= self.baud_deadline:
+            # Nothing valid arrived at the new rate, go back.
+            self.baud = self.previous_baud
+            self.baud_deadline = None
+            self.change_baud(self.baud)
+
+    def handle_command(self, buf, now):
+        output = bytearray(8)
+        output[0] = buf[0]
+
+        if buf[0] == COMMAND_STATUS1:
+            struct.pack_into('!HHHB', output, 1, self.heater_on_cycle,
+                             self.heater_off_cycle, self.dt,
+                             self.heater_on & 0xff)
+        elif buf[0] == COMMAND_STATUS2:
+            struct.pack_into('!LBBB', output, 1, self.pump_on_cycle,
+                             *pack_float(self.temperature),
+                             self.pump_on & 0xff)
+        elif buf[0] == COMMAND_STATUS3:
+            output[1:3] = pack_float(self.heater_power)
+        elif buf[0] == COMMAND_STATUS_FULL:
+            output = bytearray([buf[0], 16]) + self.pack_status()
+        elif buf[0] == COMMAND_SUBSCRIBE:
+            interval = (buf[1] << 8) + buf[2]
+            if interval == 0:
+                if self.stream_interval > 0:
+                    self.stream_interval = 0
+                    self.stream.write(write_frame(COMMAND_SUBSCRIBE, b''))
+                    return b''
+            else:
+                self.stream_interval = interval
+                self.last_push = now
+                output[1:4] = bytes([buf[1], buf[2], 1])
+        elif buf[0] == COMMAND_FRAMING:
+            # A new client starts its own sequence numbers.
+            self.last_response = b''
+            output[1:3] = bytes([1, FRAMING_VERSION])
+        elif buf[0] == COMMAND_SETPOINT:
+            current_setpoint = self.controller.setpoint
+            self.controller.setpoint = buf[1] + buf[2] / 255.0
+            output[1:3] = pack_float(self.controller.setpoint)
+            output[3:5] = pack_float(current_setpoint)
+        elif buf[0] == COMMAND_START_PUMP:
+            self.pump_on_cycle = (buf[1] << 8) + buf[2]
+        elif buf[0] == COMMAND_BAUD:
+            requested, = struct.unpack_from('!L', buf, 1)
+            if self.change_baud and requested in SUPPORTED_BAUD:
+                self.pending_baud = requested
+                output[1] = 1
+            struct.pack_into('!L', output, 2, requested)
+        elif buf[0] == COMMAND_STOP_PUMP:
+            self.pump_on_cycle = 0
+        else:
+            return bytes(output)
+
+        if buf[0] != COMMAND_BAUD:
+            # A valid request at a new baud rate confirms it.
+            self.baud_deadline = None
+
+        return bytes(output)
+
+    def push_status(self, now):
+        if self.stream_interval == 0 or \
+                now - self.last_push < self.stream_interval:
+            return
+
+        self.last_push = now
+        self.stream.write(write_frame(
+            COMMAND_STATUS_FULL,
+            struct.pack('!L', now & 0xffffffff) + self.pack_status()))
+
+
+# -------------------------------------------------------------------------
+# Device
+
+class PtyStream(object):
+    ''' The master side of a pseudo-terminal as a firmware ``Stream``.
+
+    :param wire_time: Delay writes by the time they would take on the wire
+                      at :attr:`baud`, a pty itself ignores the rate.
+    '''
+
+    def __init__(self, wire_time=False):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.buffer = collections.deque()
+        self.wire_time = wire_time
+        self.baud = BAUD
+
+    def set_baud(self, baud):
+        self.baud = baud
+
+    @property
+    def name(self):
+        return os.ttyname(self.slave)
+
+    def fill(self, timeout=0):
+        if select.select([self.master], [], [], timeout)[0]:
+            try:
+                self.buffer.extend(os.read(self.master, 1024))
+            except OSError:
+                pass
+
+    def available(self):
+        return len(self.buffer)
+
+    def read(self, size):
+        return bytes(self.buffer.popleft() for _ in range(size))
+
+    def write(self, data):
+        if self.wire_time:
+            # A start bit, 8 data bits and a stop bit per byte.
+            time.sleep(10.0 * len(data) / self.baud)
+        os.write(self.master, data)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class SimulatedSilvia(object):
+    ''' Runs the firmware loop and boiler with a 1 ms tick.
+
+    :param stream: Where commands come from and responses go to.
+    :param speed: Simulated seconds per wall clock second.
+    '''
+
+    def __init__(self, stream, setpoint=100, Kp=0.045, Ki=0.00001, Kd=0,
+                 cycle=500, y0=(system.Te, system.Te), speed=1.0):
+        self.stream = stream
+        self.speed = speed
+        self.boiler = Boiler(y0)
+        self.controller = PidController(setpoint, Kp, Ki, Kd)
+        self.loop = Loop(stream, self.controller, self.boiler, cycle)
+        if hasattr(stream, 'set_baud'):
+            self.loop.set_baud_callback(stream.set_baud, BAUD)
+        self.millis = 0
+
+    def tick(self):
+        self.millis += 1
+        self.loop.once(self.millis)
+        self.boiler.heater_on = bool(self.loop.heater_on)
+        self.boiler.step(0.001)
+
+    def run(self, duration=None, poll=0.001):
+        ''' Ticks in step with the wall clock (times `speed`) for
+            `duration` simulated seconds, or forever.
+        '''
+        start = time.monotonic()
+        end = None if duration is None else self.millis + 1000 * duration
+
+        while end is None or self.millis < end:
+            self.stream.fill(poll)
+            target = int(1000 * self.speed * (time.monotonic() - start))
+            while self.millis < target and (end is None or self.millis < end):
+                self.tick()
+                # Keep comms responsive when running faster than real time.
+                if self.millis % 10 == 0:
+                    self.stream.fill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', '--speed', type=float, default=1.0,
+                        help='Simulated seconds per second.')
+    parser.add_argument('--setpoint', type=float, default=100)
+    parser.add_argument('--kp', type=float, default=0.045)
+    parser.add_argument('--ki', type=float, default=0.00001)
+    parser.add_argument('--kd', type=float, default=0)
+    parser.add_argument('--cycle', type=int, default=500)
+    parser.add_argument('-T', '--temperature', type=float, default=system.Te,
+                        help='Initial boiler temperature.')
+    parser.add_argument('--wire-time', action='store_true',
+                        help='Delay responses by their time on the wire at '
+                             'the negotiated baud rate.')
+    args = parser.parse_args()
+
+    stream = PtyStream(args.wire_time)
+    device = SimulatedSilvia(
+        stream, args.setpoint, args.kp, args.ki, args.kd, args.cycle,
+        (args.temperature, args.temperature), args.speed)
+
+    print('Simulated Silvia on {}'.format(stream.name))
+    print('Run: COFFEE_SERIAL_PORT={} ./coffee.py status'.format(stream.name))
+    sys.stdout.flush()
+
+    try:
+        device.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+'''
+    Discrete
+    ~~~~~~~~
+    Simulates the firmware loop tick for tick. ``Loop::setHeaterPower``
+    only reads the sensor and runs the controller at cycle boundaries and
+    holds the heater on or off in between, so the boiler only sees a few
+    switching events per cycle. Between events the linear model from
+    :func:`system.coefficients` is advanced exactly with its matrix
+    exponential, which makes hours of 1 ms ticks cheap.
+'''
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import system
+from device import PidController
+
+
+#: Duration of a loop tick in seconds.
+TICK = 0.001
+
+
+class Propagator(object):
+    ''' Exact solution of the boiler model for a constant heater power.
+
+    ``A`` is diagonalized once, ``exp(A t)`` is then ``V exp(L t) V^-1``
+    and is cached per number of ticks.
+    '''
+
+    def __init__(self, tick=TICK):
+        self.A, self.b, self.c = system.coefficients()
+        self.tick = tick
+        self.eigenvalues, self.V = np.linalg.eig(self.A)
+        self.V_inv = np.linalg.inv(self.V)
+        self.A_inv = np.linalg.inv(self.A)
+        self.transitions = {}
+
+    def steady_state(self, power):
+        return -self.A_inv @ (self.b * power + self.c)
+
+    def transition(self, ticks):
+        ''' Returns ``exp(A * ticks * tick)``. '''
+        matrix = self.transitions.get(ticks)
+        if matrix is None:
+            decay = np.exp(self.eigenvalues * ticks * self.tick)
+            matrix = np.real((self.V * decay) @ self.V_inv)
+            self.transitions[ticks] = matrix
+        return matrix
+
+    def advance(self, y, power, ticks):
+        ''' Returns the state `ticks` ticks after `y` with `power` held. '''
+        if ticks <= 0:
+            return y
+        steady = self.steady_state(power)
+        return steady + self.transition(ticks) @ (y - steady)
+
+
+def simulate(controller, horizon, full_cycle=500, y0=(20, 20),
+             resolution=0.25, propagator=None):
+    ''' Steps the exact ``Loop::once`` semantics for `horizon` seconds.
+
+    A sensor read at tick ``k`` sets the heater pin for tick ``k`` itself,
+    keeps it on for ``heater_on_cycle`` more ticks and off while
+    ``heater_off_cycle > 9``. A partial cycle therefore lasts
+    ``full_cycle - 8`` ticks. Negative controller output saturates to 0
+    like the firmware's ``uint16_t`` conversion on the Cortex-M4.
+
+    :param controller: Has ``heater_power(dt, T)`` like
+                       :class:`device.PidController`.
+    :param resolution: Sensor resolution in degrees, None for exact reads.
+
+    :returns: A dict with, per sensor read, the time ``t`` (s), ``Tw``,
+              ``Tm``, the sensor reading ``T``, the controller ``output``
+              and the number of ``on`` ticks that followed.
+    '''
+    propagator = propagator or Propagator()
+    ticks = int(round(horizon / propagator.tick))
+    y = np.array(y0, dtype=float)
+
+    events = []
+    # Tick 1 only records first_call, the loop starts running at tick 2.
+    now = 2
+    last_call = 0
+
+    while now <= ticks:
+        T = y[1]
+        if resolution:
+            T = round(T / resolution) * resolution
+
+        dt = (now - last_call) & 0xffff
+        last_call = now
+        output = controller.heater_power(dt / 1000.0, T)
+
+        if output >= 1:
+            pin, on_cycle, off_cycle = 1, full_cycle, 0
+        elif output == 0:
+            pin, on_cycle, off_cycle = 0, 0, full_cycle
+        else:
+            on_cycle = int(max(0, output) * full_cycle)
+            pin, off_cycle = 1, full_cycle - on_cycle
+
+        on = pin * (1 + on_cycle)
+        off = (1 - pin) + max(0, off_cycle - 9)
+        on = min(on, ticks - now + 1)
+        off = min(off, ticks - now + 1 - on)
+
+        events.append((now * propagator.tick, y[0], y[1], T, output, on))
+
+        # At T == 140 the second bimetallic thermostat (T2) disconnects
+        power = system.heater_power if y[1] < 140 else 0
+        y = propagator.advance(y, power, on)
+        y = propagator.advance(y, 0, off)
+        now += on + off
+
+    columns = np.array(events).T
+    return dict(zip(['t', 'Tw', 'Tm', 'T', 'output', 'on'], columns))
+
+
+def continuous(Kp, Ki, Kd, setpoint, t, y0=(20, 20)):
+    ''' The same firmware PID driving the boiler as continuous power
+        through ``odeint``, for comparison.
+    '''
+    import simulation
+
+    pid = PidController(setpoint, Kp, Ki, Kd)
+    previous_t = [0]
+
+    def power(t, T):
+        # At T == 140 the second bimetallic thermostat (T2) disconnects
+        if T >= 140:
+            return 0
+
+        dt = t - previous_t[0]
+        previous_t[0] = t
+        output = pid.heater_power(dt, T)
+        return system.heater_power * min(1, max(0, output))
+
+    return simulation.simulate(power, t, y0)
+
+
+def compare(Kp, Ki=0, Kd=0, setpoint=100, horizon=3600, full_cycle=500,
+            y0=(20, 20)):
+    ''' Runs the discrete and continuous modes and returns the discrete
+        result with the continuous ``Tm`` at the same times (``Tm_ode``)
+        and the timings of both.
+    '''
+    start = time.perf_counter()
+    result = simulate(PidController(setpoint, Kp, Ki, Kd), horizon,
+                      full_cycle, y0, resolution=None)
+    result['discrete_time'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ode = continuous(Kp, Ki, Kd, setpoint, result['t'], y0)
+    result['continuous_time'] = time.perf_counter() - start
+    result['Tm_ode'] = ode[:, 1]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kp', type=float, default=0.045)
+    parser.add_argument('--ki', type=float, default=0.00001)
+    parser.add_argument('--kd', type=float, default=0)
+    parser.add_argument('--setpoint', type=float, default=100)
+    parser.add_argument('--cycle', type=int, default=500)
+    parser.add_argument('--horizon', type=float, default=7200)
+    parser.add_argument('--compare', action='store_true',
+                        help='Check against the continuous odeint mode.')
+    args = parser.parse_args()
+
+    if not args.compare:
+        start = time.perf_counter()
+        result = simulate(PidController(args.setpoint, args.kp, args.ki,
+                                        args.kd),
+                          args.horizon, args.cycle)
+        print('{:.0f} ticks, {} cycles in {:.3f}s, final Tm {:.2f}'.format(
+            args.horizon / TICK, len(result['t']),
+            time.perf_counter() - start, result['Tm'][-1]))
+        return 0
+
+    result = compare(args.kp, args.ki, args.kd, args.setpoint, args.horizon,
+                     args.cycle)
+    difference = result['Tm'] - result['Tm_ode']
+
+    print('discrete   {:8.3f}s'.format(result['discrete_time']))
+    print('continuous {:8.3f}s'.format(result['continuous_time']))
+    print('Tm difference: max {:.3f}, rms {:.3f}, final {:.3f}'.format(
+        np.max(np.abs(difference)), np.sqrt(np.mean(difference ** 2)),
+        difference[-1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+'''
+    Piecewise
+    ~~~~~~~~~
+    Event-driven simulation of on/off heater control. With the heater held
+    on or off the boiler is the linear system of :func:`system.coefficients`
+    with a constant input, so the state is known in closed form between
+    switching events::
+
+        y(t) = s + V diag(exp(L t)) V^-1 (y0 - s)
+
+    with ``s`` the steady state for that input. Threshold crossings of
+    ``Tm`` are the roots of a sum of two exponentials, which have at most
+    one extremum; it is found analytically and brackets the root for
+    ``brentq``. The simulation only does work per switching event, the
+    output grid is filled in one vectorized step at the end.
+
+    Without hysteresis the switching of the threshold controller speeds up
+    without bound as ``Tm`` settles on the setpoint. Once a switch happens
+    within :data:`HOLD_TOLERANCE` of the limit, the equilibrium held by the
+    average heater power, the state is moved onto it.
+'''
+
+import argparse
+import math
+import sys
+import time
+
+import numpy as np
+from scipy.optimize import brentq
+
+import system
+from discrete import Propagator
+
+
+#: At T == 140 the second bimetallic thermostat (T2) disconnects.
+CUTOFF = 140
+
+#: Temperatures closer than this to a switching level count as on it.
+LEVEL_TOLERANCE = 1e-6
+
+#: Switching within this distance (K) of the equilibrium on the setpoint
+#: counts as holding it.
+HOLD_TOLERANCE = 0.01
+
+
+class PiecewiseLinear(Propagator):
+    ''' :class:`discrete.Propagator` for arbitrary durations. '''
+
+    def __init__(self):
+        super().__init__()
+        self.rates = np.real(self.eigenvalues)
+
+    def modes(self, y, power):
+        ''' Returns ``s`` and ``K`` with ``y(t) = s + K exp(L t)``. '''
+        steady = self.steady_state(power)
+        weights = self.V_inv @ (np.asarray(y, dtype=float) - steady)
+        return steady, np.real(self.V * weights)
+
+    def crossing(self, y, power, level, horizon):
+        ''' Returns the first time in ``(0, horizon]`` at which ``Tm``
+            starting at `y` reaches `level`, or None.
+        '''
+        steady, K = self.modes(y, power)
+        (k0, k1), (l0, l1) = K[1], self.rates
+
+        def f(t):
+            return steady[1] + k0 * math.exp(l0 * t) + \
+                k1 * math.exp(l1 * t) - level
+
+        # f' = k0 l0 exp(l0 t) + k1 l1 exp(l1 t) vanishes at most once.
+        points = [0.0]
+        if k0 * l0 != 0 and l0 != l1:
+            ratio = -(k1 * l1) / (k0 * l0)
+            if ratio > 0:
+                extremum = math.log(ratio) / (l0 - l1)
+                if 0 < extremum < horizon:
+                    points.append(extremum)
+        points.append(horizon)
+
+        values = [f(_) for _ in points]
+        if abs(values[0]) < LEVEL_TOLERANCE:
+            # Just switched on this level, look for the next crossing.
+            values[0] = 0.0
+
+        for (a, fa), (b, fb) in zip(zip(points, values),
+                                    zip(points[1:], values[1:])):
+            if fb == 0:
+                return b
+            if fa * fb < 0:
+                return brentq(f, a, b, xtol=1e-12)
+        return None
+
+    def holding_power(self, level):
+        ''' Returns the constant power with ``Tm`` at rest at `level`. '''
+        cold = self.steady_state(0)[1]
+        return (level - cold) / (self.steady_state(1)[1] - cold)
+
+    def sample(self, starts, states, powers, t):
+        ''' Returns the states at the times `t` of a simulation that starts
+            segment ``i`` at ``starts[i]`` in ``states[i]`` with
+            ``powers[i]``.
+        '''
+        index = np.searchsorted(starts, t, side='right') - 1
+        index = np.clip(index, 0, len(starts) - 1)
+
+        steady = np.array([self.steady_state(_) for _ in powers])
+        weights = (states - steady) @ self.V_inv.T
+        decay = np.exp(np.outer(t - starts[index], self.eigenvalues))
+        return np.real((weights[index] * decay) @ self.V.T) + steady[index]
+
+
+def threshold(setpoint, horizon, y0=(20, 20), hysteresis=0, t=None,
+              integrator=None):
+    ''' Simulates ``simulation.ThresholdController``: full power while
+        ``Tm`` is below `setpoint`, cut at :data:`CUTOFF`.
+
+    :param hysteresis: The heater comes back on at ``setpoint - hysteresis``
+                       instead of at the setpoint.
+    :param t: Optional output times.
+
+    :returns: A dict with the ``switch`` times, the ``power`` from each
+              switch on, and with `t` also ``t``, ``Tw`` and ``Tm``. A
+              last power between 0 and ``heater_power`` holds the
+              setpoint from there on.
+    '''
+    integrator = integrator or PiecewiseLinear()
+    off_level = min(setpoint, CUTOFF)
+    on_level = off_level - hysteresis
+
+    now = 0.0
+    y = np.array(y0, dtype=float)
+    on = y[1] < off_level
+    starts, states, powers = [], [], []
+
+    while now < horizon:
+        power = system.heater_power if on else 0
+        starts.append(now)
+        states.append(y)
+        powers.append(power)
+
+        level = off_level if on else on_level
+        duration = integrator.crossing(y, power, level, horizon - now)
+        if duration is None:
+            break
+
+        now += duration
+        steady, K = integrator.modes(y, power)
+        y = steady + K @ np.exp(integrator.rates * duration)
+        y[1] = level
+        on = not on
+
+        if not hysteresis and now < horizon:
+            power = min(integrator.holding_power(level), system.heater_power)
+            hold = integrator.steady_state(power)
+            if abs(y[0] - hold[0]) < HOLD_TOLERANCE:
+                starts.append(now)
+                states.append(hold)
+                powers.append(power)
+                break
+
+    result = {
+        'switch': np.array(starts),
+        'power': np.array(powers, dtype=float),
+    }
+
+    if t is not None:
+        sampled = integrator.sample(np.array(starts), np.array(states),
+                                    powers, np.asarray(t, dtype=float))
+        result.update(t=t, Tw=sampled[:, 0], Tm=sampled[:, 1])
+
+    return result
+
+
+def pwm(duty, period, horizon, y0=(20, 20), t=None, integrator=None):
+    ''' Simulates a PWM controller that samples ``Tm`` at the start of
+        every `period` and keeps the heater on for ``duty(now, Tm)`` of it.
+
+    The heater is also cut when ``Tm`` reaches :data:`CUTOFF` during an on
+    phase. Returns a dict like :func:`threshold`.
+    '''
+    integrator = integrator or PiecewiseLinear()
+    now = 0.0
+    y = np.array(y0, dtype=float)
+    starts, states, powers = [], [], []
+
+    def hold(y, power, duration):
+        steady, K = integrator.modes(y, power)
+        return steady + K @ np.exp(integrator.rates * duration)
+
+    while now < horizon:
+        on = min(1.0, max(0.0, duty(now, y[1]))) * period
+        end = min(now + period, horizon)
+        on = min(on, end - now)
+
+        if on > 0 and y[1] < CUTOFF:
+            cut = integrator.crossing(y, system.heater_power, CUTOFF, on)
+            on = cut if cut is not None else on
+            starts.append(now)
+            states.append(y)
+            powers.append(system.heater_power)
+            y = hold(y, system.heater_power, on)
+
+        if now + on < end:
+            starts.append(now + on)
+            states.append(y)
+            powers.append(0)
+            y = hold(y, 0, end - now - on)
+
+        now = end
+
+    result = {
+        'switch': np.array(starts),
+        'power': np.array(powers, dtype=float),
+    }
+
+    if t is not None:
+        sampled = integrator.sample(np.array(starts), np.array(states),
+                                    powers, np.asarray(t, dtype=float))
+        result.update(t=t, Tw=sampled[:, 0], Tm=sampled[:, 1])
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--setpoint', type=float, default=100)
+    parser.add_argument('--hysteresis', type=float, default=0)
+    parser.add_argument('--horizon', type=float, default=3600)
+    parser.add_argument('--dt', type=float, default=0.025,
+                        help='Output resolution in seconds.')
+    parser.add_argument('--compare', action='store_true',
+                        help='Check against simulation.simulate with vode.')
+    args = parser.parse_args()
+
+    t = np.arange(0, args.horizon, args.dt)
+    start = time.perf_counter()
+    result = threshold(args.setpoint, args.horizon, hysteresis=args.hysteresis,
+                       t=t)
+    elapsed = time.perf_counter() - start
+
+    print('{} switches, {} output points in {:.3f}s, final Tm {:.3f}'.format(
+        len(result['switch']), len(t), elapsed, result['Tm'][-1]))
+
+    if args.compare:
+        import simulation
+
+        if args.hysteresis:
+            print('--compare needs --hysteresis 0')
+            return -1
+
+        start = time.perf_counter()
+        reference = simulation.simulate(
+            simulation.ThresholdController(args.setpoint), t, solver='vode')
+        elapsed = time.perf_counter() - start
+        difference = np.abs(result['Tm'] - reference[:, 1])
+        print('vode {:.3f}s, Tm difference: max {:.4f}, rms {:.4f}'.format(
+            elapsed, difference.max(), np.sqrt(np.mean(difference ** 2))))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
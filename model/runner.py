@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+'''
+    Runner
+    ~~~~~~
+    Runs independent simulation jobs in a process pool and caches each
+    result on disk. The cache key is a hash of the job and the constants in
+    :mod:`system`, so a repeated sweep only simulates the new points and a
+    change to the thermal model invalidates everything.
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import system
+
+
+#: Bump when the simulation itself changes in a way the key doesn't see.
+CACHE_VERSION = 2
+
+#: A simulation job, `controller` is ``pid``, ``real`` (libcontroller.so)
+#: or ``threshold`` and `solver` one of :func:`simulation.simulate`'s.
+Job = collections.namedtuple('Job', [
+    'controller', 'Kp', 'Ki', 'Kd', 'setpoint', 'y0', 'horizon', 'dt',
+    'solver'])
+Job.__new__.__defaults__ = (0, 0, 0, 100, (20, 20), 7200, 0.05, 'odeint')
+
+
+def system_constants():
+    return {k: v for k, v in sorted(vars(system).items())
+            if not k.startswith('_') and isinstance(v, (int, float))}
+
+
+def job_key(job):
+    ''' Returns the cache key of `job`. '''
+    description = json.dumps({
+        'version': CACHE_VERSION,
+        'job': job._asdict(),
+        'system': system_constants(),
+    }, sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def create_controller(job):
+    import simulation
+
+    if job.controller == 'pid':
+        return simulation.PidController(job.setpoint, job.Kp, job.Ki, job.Kd)
+    elif job.controller == 'real':
+        return simulation.RealPidController(
+            job.setpoint, job.Kp, job.Ki, job.Kd)
+    elif job.controller == 'threshold':
+        return simulation.ThresholdController(job.setpoint)
+
+    raise ValueError('Unknown controller {}'.format(job.controller))
+
+
+def run_job(job):
+    ''' Simulates `job`, this runs in the worker processes.
+
+    :returns: A dict with ``t``, ``Tw``, ``Tm`` and the ``wall_time``.
+    '''
+    import simulation
+
+    start = time.perf_counter()
+    t = np.arange(0, job.horizon, job.dt)
+    result = simulation.simulate(create_controller(job), t, job.y0,
+                                 job.solver)
+
+    return {
+        't': t,
+        'Tw': result[:, 0],
+        'Tm': result[:, 1],
+        'wall_time': time.perf_counter() - start,
+    }
+
+
+class Cache(object):
+    ''' A directory of ``<key>.npz`` results. '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, job):
+        return os.path.join(self.path, '{}.npz'.format(job_key(job)))
+
+    def load(self, job):
+        try:
+            with np.load(self.filename(job)) as data:
+                return {k: data[k] for k in data.files}
+        except (OSError, ValueError):
+            return None
+
+    def store(self, job, result):
+        filename = self.filename(job)
+        partial = '{}.{}.tmp.npz'.format(filename[:-4], os.getpid())
+        np.savez(partial, **result)
+        os.replace(partial, filename)
+
+
+def run(jobs, cache='.simcache', workers=None, report=None):
+    ''' Runs `jobs` and returns their results in the same order.
+
+    Every result has a ``cached`` flag next to its ``wall_time``, which is
+    the time it took to simulate (also when it came from the cache).
+
+    :param cache: Cache directory, None disables caching.
+    :param workers: Number of processes, defaults to the CPU count.
+    :param report: Called with ``(job, result)`` as results come in.
+    '''
+    cache = Cache(cache) if cache else None
+    results = [None] * len(jobs)
+    todo = {}
+
+    for i, job in enumerate(jobs):
+        result = cache.load(job) if cache else None
+        if result is None:
+            todo.setdefault(job, []).append(i)
+            continue
+        result['cached'] = True
+        results[i] = result
+        if report:
+            report(job, result)
+
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(run_job, job): job for job in todo}
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                result = future.result()
+                if cache:
+                    cache.store(job, result)
+                result['cached'] = False
+                for i in todo[job]:
+                    results[i] = result
+                if report:
+                    report(job, result)
+
+    return results
+
+
+def print_report(job, result):
+    print('{:10} Kp={:<8g} Ki={:<8g} Kd={:<8g} sp={:<6g} {:8.2f}s{}'.format(
+        job.controller, job.Kp, job.Ki, job.Kd, job.setpoint,
+        float(result['wall_time']), ' (cached)' if result['cached'] else ''))
+    sys.stdout.flush()
+
+
+def main():
+    from sweep import parse_range
+
+    parser = argparse.ArgumentParser(
+        description='Ranges are given as start:stop:num.')
+    parser.add_argument('-c', '--controller', default='pid',
+                        choices=['pid', 'real', 'threshold'])
+    parser.add_argument('--kp', type=parse_range, default='0.065')
+    parser.add_argument('--ki', type=parse_range, default='0')
+    parser.add_argument('--kd', type=parse_range, default='0')
+    parser.add_argument('--setpoint', type=parse_range, default='100')
+    parser.add_argument('--horizon', type=float, default=7200)
+    parser.add_argument('--dt', type=float, default=0.05)
+    parser.add_argument('--solver', default='odeint',
+                        choices=['odeint', 'vode', 'lsoda', 'bdf'])
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--cache', default='.simcache',
+                        help='Cache directory, empty to disable.')
+    args = parser.parse_args()
+
+    jobs = [Job(args.controller, float(Kp), float(Ki), float(Kd),
+                float(setpoint), (20, 20), args.horizon, args.dt, args.solver)
+            for Kp, Ki, Kd, setpoint in itertools.product(
+                args.kp, args.ki, args.kd, args.setpoint)]
+
+    start = time.perf_counter()
+    results = run(jobs, args.cache, args.workers, print_report)
+    computed = [_ for _ in results if not _['cached']]
+
+    print('{} jobs, {} simulated in {:.2f}s wall time ({:.2f}s cpu)'.format(
+        len(jobs), len(computed), time.perf_counter() - start,
+        sum(float(_['wall_time']) for _ in computed)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,387 @@
+'''
+    Simulation
+    ~~~~~~~~~~
+    Controller implementations and solvers shared by ``simulate.py`` and the
+    simulation runners. scipy is only imported by the solvers.
+'''
+
+import ctypes
+import functools
+
+import numpy as np
+
+import system
+
+
+# -------------------------------------------------------------------------
+# Controller implementations
+
+class PowerRecorder (object):
+    ''' Records the heater output on the output time grid in preallocated
+        arrays.
+
+    Solvers evaluate the controller many times per output interval,
+    rejected steps included. Slot ``i`` keeps the last output evaluated in
+    ``[t[i], t[i + 1])``, so memory is fixed by the grid and not by the
+    number of evaluations.
+
+    :param decimate: Keep one slot per `decimate` grid points.
+    :param capacity: Keep only the last `capacity` slots, a ring buffer.
+    '''
+
+    def __init__(self, decimate=1, capacity=None):
+        self.decimate = decimate
+        self.capacity = capacity
+        self.calls = 0
+        self.grid = None
+
+    def align(self, t):
+        ''' Allocates the slots for the output times `t` and clears them. '''
+        grid = np.asarray(t, dtype=float)[::self.decimate]
+        size = len(grid)
+        if self.capacity:
+            size = min(size, self.capacity)
+
+        self.grid = grid
+        self.times = np.full(size, np.nan)
+        self.values = np.full(size, np.nan)
+        self.slots = np.full(size, -1, dtype=np.int64)
+        self.calls = 0
+
+        # Uniform grids are indexed arithmetically instead of searching.
+        steps = np.diff(grid)
+        if len(steps) and np.allclose(steps, steps[0]):
+            self._start, self._rate = grid[0], 1 / steps[0]
+        else:
+            self._start, self._rate = None, None
+
+    def __call__(self, t, power):
+        self.calls += 1
+        if self.grid is None or t < self.grid[0]:
+            return
+
+        if self._rate is not None:
+            index = int((t - self._start) * self._rate + 1e-9)
+        else:
+            index = int(np.searchsorted(self.grid, t, side='right')) - 1
+        index = min(index, len(self.grid) - 1)
+
+        slot = index % len(self.slots)
+        if index >= self.slots[slot]:
+            self.slots[slot] = index
+            self.times[slot] = self.grid[index]
+            self.values[slot] = power
+
+    def __len__(self):
+        if self.grid is None:
+            return 0
+        return int(np.count_nonzero(self.slots >= 0))
+
+    def arrays(self):
+        ''' Returns the recorded ``(t, power)`` in time order. '''
+        if self.grid is None:
+            return np.empty(0), np.empty(0)
+        order = np.argsort(self.slots)
+        order = order[self.slots[order] >= 0]
+        return self.times[order], self.values[order]
+
+    def duty_cycle(self):
+        ''' Returns ``t`` and the output in percent of the heater power. '''
+        t, power = self.arrays()
+        return t, power / system.heater_power * 100
+
+
+class Controller (object):
+    ''' Temperature controller base class, takes care or storing the heater
+        output for later plotting.
+
+    :param setpoint: The desired temperature in degrees centigrade.
+    :param recorder: A :class:`PowerRecorder` for the output, the default
+                     one records every grid point once aligned.
+    '''
+
+    def __init__(self, setpoint, recorder=None):
+        self.setpoint = setpoint
+        self.power = PowerRecorder() if recorder is None else recorder
+
+    def heater_power(self, t, T):
+        raise NotImplementedError()
+
+    def gain(self, t, T):
+        ''' Returns ``dP/dT`` at the last evaluation, for the closed-loop
+            Jacobian. Zero unless a controller overrides it.
+        '''
+        return 0
+
+    def __call__(self, t, T):
+        # At T == 140 the second bimetallic thermostat (T2) disconnects
+        if T >= 140:
+            return 0
+
+        power = self.heater_power(t, T)
+        self.power(t, power)
+
+        if t >= 3600:
+            return 0
+        return power
+
+
+def pid_gain(Kp, output, t, T):
+    ''' ``dP/dT`` of a PID controller whose last unclipped `output` was
+        `output`: the proportional term while the output isn't saturated,
+        the heater isn't cut (T2, or after an hour) and zero otherwise.
+
+    The integral term has no instantaneous dependence on ``T``. The
+    derivative term divides by the step between evaluations, which the
+    solver picks, so it is left out.
+    '''
+    if T >= 140 or t >= 3600 or not 0 < output < 1:
+        return 0
+    return -system.heater_power * Kp
+
+
+class ControllerContext (ctypes.Structure):
+    _fields_ = [
+        ('setpoint', ctypes.c_float),
+        ('Kp', ctypes.c_float),
+        ('Ki', ctypes.c_float),
+        ('Kd', ctypes.c_float),
+        ('integral', ctypes.c_float),
+        ('previous_error', ctypes.c_float),
+    ]
+
+
+#: The firmware controller, built by ``make`` in this directory.
+LIBRARY = './libcontroller.so'
+
+
+def load_library(path=LIBRARY):
+    ''' Returns the controller library at `path`.
+
+    :raises RuntimeError: The library is missing or can't be loaded, it
+                          needs the C ``controller_new`` and
+                          ``controller_power`` of ``../teensy/controller.c``
+                          that the Makefile builds from.
+    '''
+    try:
+        return ctypes.cdll.LoadLibrary(path)
+    except OSError as e:
+        raise RuntimeError(
+            '{} could not be loaded ({}); the real controller needs it built '
+            'with make from ../teensy/controller.c'.format(path, e)) from e
+
+
+class RealPidController (Controller):
+
+    def __init__(self, setpoint, Kp, Ki, Kd, recorder=None):
+        super().__init__(setpoint, recorder)
+        self.lib = load_library()
+        self.lib.controller_new.restype = ControllerContext
+        self.lib.controller_power.restype = ctypes.c_float
+        self._last_t = 0
+        self._ratio = 0
+
+        self._ctx = self.lib.controller_new(
+            ctypes.c_float(setpoint),
+            ctypes.c_float(Kp),
+            ctypes.c_float(Ki),
+            ctypes.c_float(Kd))
+
+    def heater_power(self, t, T):
+        dt = t - self._last_t
+        self._last_t = t
+
+        ratio = self.lib.controller_power(
+            ctypes.byref(self._ctx),
+            ctypes.c_float(dt), ctypes.c_float(T))
+        self._ratio = ratio
+
+        return system.heater_power * min(1, max(0, ratio))
+
+    def gain(self, t, T):
+        return pid_gain(self._ctx.Kp, self._ratio, t, T)
+
+
+#: Array of :class:`ControllerContext` as a NumPy dtype.
+CONTEXT_DTYPE = np.dtype([(name, np.float32)
+                          for name, _ in ControllerContext._fields_])
+
+
+class BatchRealPidController (object):
+    ''' Runs many ``libcontroller.so`` contexts through the
+        ``controller_power_batch`` entry point.
+
+    The contexts live in a NumPy array with the C struct layout that is
+    handed to the library without copying, gains and setpoints broadcast to
+    one context per configuration.
+    '''
+
+    def __init__(self, setpoint, Kp, Ki, Kd, library=LIBRARY):
+        self.lib = load_library(library)
+        self.lib.controller_new.restype = ControllerContext
+        self.lib.controller_power_batch.restype = None
+        self.lib.controller_power_batch.argtypes = [
+            np.ctypeslib.ndpointer(CONTEXT_DTYPE, flags='C_CONTIGUOUS'),
+            ctypes.c_int,
+            ctypes.c_int,
+            np.ctypeslib.ndpointer(np.float32, flags='C_CONTIGUOUS'),
+            np.ctypeslib.ndpointer(np.float32, flags='C_CONTIGUOUS'),
+            np.ctypeslib.ndpointer(np.float32, flags='C_CONTIGUOUS'),
+        ]
+
+        params = np.broadcast_arrays(*(np.atleast_1d(_) for _ in (
+            setpoint, Kp, Ki, Kd)))
+        self.contexts = np.empty(len(params[0]), CONTEXT_DTYPE)
+
+        # Let the library initialize every context like controller_new does
+        # for RealPidController.
+        for i, values in enumerate(zip(*params)):
+            ctx = self.lib.controller_new(
+                *(ctypes.c_float(_) for _ in values))
+            self.contexts[i] = np.frombuffer(
+                ctypes.string_at(ctypes.addressof(ctx), ctypes.sizeof(ctx)),
+                CONTEXT_DTYPE)[0]
+
+    def __len__(self):
+        return len(self.contexts)
+
+    def step(self, dt, T):
+        ''' Steps every context over the columns of `T`.
+
+        :param dt: Step size(s), a scalar or one per column.
+        :param T: Temperatures, ``(N,)`` for one step or ``(N, M)``.
+
+        :returns: The controller output with the shape of `T`.
+        '''
+        T = np.ascontiguousarray(T, dtype=np.float32)
+        n = len(self.contexts)
+        m = T.size // n
+        dt = np.ascontiguousarray(np.broadcast_to(dt, (m,)), np.float32)
+        output = np.empty_like(T)
+
+        self.lib.controller_power_batch(self.contexts, n, m, dt, T, output)
+        return output
+
+
+class PidController (Controller):
+
+    def __init__(self, setpoint, Kp, Ki, Kd, recorder=None):
+        super().__init__(setpoint, recorder)
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+        self._previous_t = 0
+        self._integral = 0
+        self._previous_error = 0
+        self._output = 0
+
+    def heater_power(self, t, T):
+        dt = t - self._previous_t
+        self._previous_t = t
+
+        error = self.setpoint - T
+        self._integral += error * dt
+
+        if dt == 0:
+            derivative = 0
+        else:
+            derivative = (error - self._previous_error) / dt
+
+        output = self.Kp * error + \
+            self.Ki * self._integral + \
+            self.Kd * derivative
+        self._previous_error = error
+        self._output = output
+
+        return system.heater_power * min(1, max(0, output))
+
+    def gain(self, t, T):
+        return pid_gain(self.Kp, self._output, t, T)
+
+
+class ThresholdController (Controller):
+
+    def __init__(self, setpoint, recorder=None):
+        super().__init__(setpoint, recorder)
+
+    def heater_power(self, t, T):
+        return system.heater_power * (T < self.setpoint)
+
+# -------------------------------------------------------------------------
+# Solver for stiff systems
+
+
+def odereal(model, jacobian, y0, t, integrator='vode'):
+    ''' Integrates with the real-valued ``vode`` (BDF) or ``lsoda``
+        integrator of ``scipy.integrate.ode``, using the analytic
+        `jacobian` instead of finite differences.
+
+    `model` and `jacobian` take ``(y, t)`` like for ``odeint``.
+    '''
+    from scipy.integrate import ode
+
+    result = np.zeros((len(t), len(y0)))
+    r = ode(lambda t, y: model(y, t), lambda t, y: jacobian(y, t))
+    if integrator == 'vode':
+        r.set_integrator('vode', method='bdf', with_jacobian=True)
+    else:
+        r.set_integrator('lsoda')
+    r.set_initial_value(y0, t[0])
+    result[0] = y0
+    step = 1
+    while r.successful() and (step < len(t)):
+        r.integrate(t[step])
+        result[step] = r.y
+        step += 1
+    return result
+
+
+def odebdf(model, y0, t):
+    from scipy.integrate import ode
+
+    result = np.zeros((len(t), len(y0)))
+    sys = lambda y, t: model(t, y)  # bdf requires swapped arguments
+    r = ode(sys).set_integrator('zvode', method='bdf')
+    r.set_initial_value(y0, t[0])
+    result[0] = y0
+    step = 1
+    while r.successful() and (step < len(t)):
+        r.integrate(t[step])
+        result[step] = np.real(r.y)
+        step += 1
+    return result
+
+
+# -------------------------------------------------------------------------
+# Simulation
+
+def simulate(controller, t, y0=(20, 20), solver='odeint'):
+    ''' Simulates the boiler with `controller` over the time points `t`.
+
+    :param solver: ``odeint`` on :class:`system.System`, ``vode`` or
+                   ``lsoda`` (:func:`odereal`) with its closed-loop
+                   Jacobian, or ``bdf`` (:func:`odebdf` on
+                   :func:`system.model`).
+
+    The :class:`PowerRecorder` of `controller` is aligned to `t`.
+
+    :returns: An array with a ``(Tw, Tm)`` row per time point.
+    '''
+    if isinstance(controller, Controller):
+        controller.power.align(t)
+
+    compiled = system.compiled()
+    model = functools.partial(compiled.rhs, controller)
+    jacobian = functools.partial(compiled.jacobian, controller)
+
+    if solver == 'odeint':
+        # odeint stays on its non-stiff method here, a Jacobian only costs.
+        from scipy.integrate import odeint
+        return odeint(model, list(y0), t)
+    elif solver in ('vode', 'lsoda'):
+        return odereal(model, jacobian, list(y0), t, solver)
+    elif solver == 'bdf':
+        return odebdf(functools.partial(system.model, controller),
+                      list(y0), t)
+
+    raise ValueError('Unknown solver {}'.format(solver))
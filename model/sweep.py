@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+'''
+    Sweep
+    ~~~~~
+    Simulates a grid of PID tunings at once. All configurations share one
+    batched ``(N, 2)`` state array that is advanced with a fixed-step RK4
+    integrator over the :func:`system.model` equations.
+'''
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import system
+
+
+def grid(Kp, Ki=0, Kd=0, setpoint=100):
+    ''' Returns the cartesian product of the given values as four flat
+        arrays, each argument can be a scalar or a sequence.
+    '''
+    mesh = np.meshgrid(*(np.atleast_1d(np.asarray(_, dtype=float))
+                         for _ in (Kp, Ki, Kd, setpoint)), indexing='ij')
+    return tuple(_.ravel() for _ in mesh)
+
+
+def rk4_step(dt, plant=None):
+    ''' Returns ``M``, ``g`` and ``h`` such that one classic RK4 step of
+        :func:`system.model` with constant power ``P`` is
+        ``y + dt = M y + g P + h``.
+
+    The model is linear, so the four RK4 stages collapse into this affine
+    map which is applied to all configurations with a single product.
+
+    :param plant: Optional :func:`system.coefficients` overrides, arrays
+                  give stacked maps with one per configuration.
+    '''
+    A, b, c = system.coefficients(**(plant or {}))
+    hA = dt * A
+    eye = np.eye(2)
+    M = eye + hA + hA @ hA / 2 + hA @ hA @ hA / 6 + hA @ hA @ hA @ hA / 24
+    K = dt * (eye + hA / 2 + hA @ hA / 6 + hA @ hA @ hA / 24)
+    return M, (K @ b[..., None])[..., 0], (K @ c[..., None])[..., 0]
+
+
+def sweep(Kp, Ki=0, Kd=0, setpoint=100, horizon=3600, dt=0.5,
+          y0=(20, 20), tolerance=0.5, window=600, record=None,
+          real=False, product=True, plant=None):
+    ''' Simulates every combination of the given gains and setpoints.
+
+    The controller is the PID of ``simulate.PidController`` sampled once
+    per `dt` step and held during the step, its output is clipped to
+    ``[0, 1]`` of the heater power and cut at 140 degrees (T2). The default
+    `dt` matches the 500 ms cycle at which the firmware runs its PID.
+
+    :param tolerance: Band around the setpoint (in degrees) for the settling
+                      time.
+    :param window: The steady-state error is the mean error over the last
+                   `window` seconds.
+    :param record: Optionally keep ``Tm`` every `record` seconds.
+    :param real: Use the firmware controller arithmetic of
+                 ``libcontroller.so`` through
+                 :class:`simulation.BatchRealPidController`.
+    :param product: False broadcasts the gains and setpoints against each
+                    other instead of taking every combination.
+    :param plant: Optional ``Rf``, ``Re`` and ``Cw`` by name, scalars or
+                  one value per configuration.
+
+    :returns: A dict with the flat ``Kp``, ``Ki``, ``Kd`` and ``setpoint``
+              arrays and, per configuration, the ``overshoot``,
+              ``settling_time`` and ``steady_state_error``, and the
+              `plant` arrays. With `record` also ``t`` and ``Tm``
+              (configurations by samples).
+    '''
+    if product:
+        Kp, Ki, Kd, setpoint = grid(Kp, Ki, Kd, setpoint)
+
+    plant = dict(plant or {})
+    Kp, Ki, Kd, setpoint, *values = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(_, dtype=float))
+          for _ in [Kp, Ki, Kd, setpoint] + list(plant.values())))
+    plant = dict(zip(plant, values))
+    n = len(Kp)
+    steps = int(round(horizon / dt))
+    window_start = steps - int(round(window / dt))
+
+    if real:
+        from simulation import BatchRealPidController
+        controller = BatchRealPidController(setpoint, Kp, Ki, Kd)
+
+    M, g, h = rk4_step(dt, plant)
+    m00, m01, m10, m11 = (M[..., 0, 0], M[..., 0, 1],
+                          M[..., 1, 0], M[..., 1, 1])
+    Tw = np.full(n, float(y0[0]))
+    Tm = np.full(n, float(y0[1]))
+    integral = np.zeros(n)
+    previous_error = setpoint - Tm
+    error = np.empty(n)
+    power = np.empty(n)
+
+    peak = Tm.copy()
+    last_outside = np.zeros(n)
+    error_sum = np.zeros(n)
+
+    if record:
+        every = max(1, int(round(record / dt)))
+        samples = np.empty((n, steps // every + 1))
+        samples[:, 0] = Tm
+
+    for step in range(steps):
+        if real:
+            # The firmware sees dt == 0 on the first evaluation as well.
+            power[:] = controller.step(dt if step else 0, Tm)
+        else:
+            np.subtract(setpoint, Tm, out=error)
+            integral += error * dt
+
+            np.multiply(Kp, error, out=power)
+            power += Ki * integral
+            if step:
+                power += Kd * ((error - previous_error) / dt)
+            previous_error, error = error, previous_error
+
+        np.clip(power, 0, 1, out=power)
+        power *= system.heater_power
+        power[Tm >= 140] = 0
+
+        Tw, Tm = (m00 * Tw + m01 * Tm + g[..., 0] * power + h[..., 0],
+                  m10 * Tw + m11 * Tm + g[..., 1] * power + h[..., 1])
+
+        np.maximum(peak, Tm, out=peak)
+        last_outside[np.abs(Tm - setpoint) > tolerance] = (step + 1) * dt
+        if step >= window_start:
+            error_sum += setpoint - Tm
+        if record and (step + 1) % every == 0:
+            samples[:, (step + 1) // every] = Tm
+
+    retval = {
+        'Kp': Kp,
+        'Ki': Ki,
+        'Kd': Kd,
+        'setpoint': setpoint,
+        'overshoot': np.maximum(peak - setpoint, 0),
+        'settling_time': last_outside,
+        'steady_state_error': error_sum / max(1, steps - window_start),
+    }
+    retval.update(plant)
+
+    if record:
+        retval['t'] = np.arange(samples.shape[1]) * every * dt
+        retval['Tm'] = samples
+
+    return retval
+
+
+def parse_range(value):
+    ''' Parses ``start:stop:num`` into a linspace, or a single number. '''
+    parts = [float(_) for _ in value.split(':')]
+    if len(parts) == 1:
+        return np.array(parts)
+    start, stop, num = parts
+    return np.linspace(start, stop, int(num))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ranges are given as start:stop:num.')
+    parser.add_argument('--kp', type=parse_range, default='0.01:0.1:10')
+    parser.add_argument('--ki', type=parse_range, default='0')
+    parser.add_argument('--kd', type=parse_range, default='0')
+    parser.add_argument('--setpoint', type=parse_range, default='100')
+    parser.add_argument('--horizon', type=float, default=3600)
+    parser.add_argument('--dt', type=float, default=0.5)
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--real', action='store_true',
+                        help='Use the controller from libcontroller.so.')
+    parser.add_argument('-n', '--top', type=int, default=10,
+                        help='Number of configurations to show.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        result = sweep(args.kp, args.ki, args.kd, args.setpoint,
+                       horizon=args.horizon, dt=args.dt,
+                       tolerance=args.tolerance, real=args.real)
+    except RuntimeError as e:
+        print(e)
+        return -1
+    elapsed = time.perf_counter() - start
+
+    print('{} configurations in {:.2f}s'.format(len(result['Kp']), elapsed))
+    print('{:>10} {:>10} {:>10} {:>8} {:>10} {:>10} {:>10}'.format(
+        'Kp', 'Ki', 'Kd', 'setpoint', 'overshoot', 'settling', 'ss error'))
+
+    order = np.lexsort((result['overshoot'], result['settling_time']))
+    for i in order[:args.top]:
+        print('{:10.4g} {:10.4g} {:10.4g} {:8.1f} {:10.2f} {:10.1f} '
+              '{:10.3f}'.format(
+                  result['Kp'][i], result['Ki'][i], result['Kd'][i],
+                  result['setpoint'][i], result['overshoot'][i],
+                  result['settling_time'][i],
+                  result['steady_state_error'][i]))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,6 +7,8 @@
 
 import math
 
+import numpy as np
+
 # -------------------------------------------------------------------------
 # System Parameters
 
@@ -59,3 +61,68 @@ def model(fn, y, t):
         ((-1 / (Rf*Cw)) * y[0] + (1 / (Cw * Rf)) * y[1] + fn(t, y[1]) / Cw),
         ((1 / (Rf * Cm)) * y[0] - (1 / (Rf * Cm) + 1 /
          (Re * Cm)) * y[1] + (1 / (Re * Cm)) * Te)]
+
+
+def coefficients(Rf=None, Re=None, Cw=None):
+    ''' Returns ``A``, ``b`` and ``c`` of :func:`model` written as the linear
+        system ``dy/dt = A y + b P + c``, with ``P`` the heater power.
+
+    `Rf`, `Re` and `Cw` override the module parameters. Given as arrays the
+    results are stacked, ``A`` with shape ``(N, 2, 2)``.
+    '''
+    Rf = globals()['Rf'] if Rf is None else np.asarray(Rf, dtype=float)
+    Re = globals()['Re'] if Re is None else np.asarray(Re, dtype=float)
+    Cw = globals()['Cw'] if Cw is None else np.asarray(Cw, dtype=float)
+
+    a, b, c, w = np.broadcast_arrays(
+        1 / (Rf * Cw), 1 / (Rf * Cm), 1 / (Re * Cm), 1 / Cw)
+    zero = np.zeros_like(a)
+
+    return (np.stack([np.stack([-a, a], -1), np.stack([b, -(b + c)], -1)],
+                     -2),
+            np.stack([w, zero], -1),
+            np.stack([zero, c * Te], -1))
+
+
+class System(object):
+    ''' :func:`model` with its coefficients computed once.
+
+    The right-hand side works on cached scalars, which is what ``odeint``
+    calls most. :meth:`jacobian` is the closed-loop Jacobian: ``A`` plus
+    the controller feedback ``b dP/dTm``, taken from the controller's
+    ``gain(t, T)`` when it has one.
+    '''
+
+    def __init__(self):
+        self.A, self.b, self.c = coefficients()
+        (self.a00, self.a01), (self.a10, self.a11) = self.A.tolist()
+        self.b0 = float(self.b[0])
+        self.c1 = float(self.c[1])
+
+    def rhs(self, fn, y, t):
+        ''' Same arguments and result as :func:`model`. '''
+        Tw, Tm = y
+        return [self.a00 * Tw + self.a01 * Tm + self.b0 * fn(t, Tm),
+                self.a10 * Tw + self.a11 * Tm + self.c1]
+
+    def jacobian(self, fn, y, t):
+        ''' Jacobian of :meth:`rhs` with the same arguments. '''
+        gain = getattr(fn, 'gain', None)
+        dP = gain(t, y[1]) if gain is not None else 0
+        if not dP:
+            return self.A
+
+        J = self.A.copy()
+        J[0, 1] += self.b0 * dP
+        return J
+
+
+_compiled = None
+
+
+def compiled():
+    ''' Returns the shared :class:`System`, built on first use. '''
+    global _compiled
+    if _compiled is None:
+        _compiled = System()
+    return _compiled
@@ -1,4 +1,6 @@
 
+#include <string.h>
+
 #include "Loop.h"
 
 #define PACK16(a, n, o) a[0+o] = n >> 8; a[1+o] = n & 0xff
@@ -17,7 +19,9 @@ void Loop::once (uint32_t now) {
 
     setHeaterPower(now);
     setPumpCycle();
-    pollComms();
+    pollComms(now);
+    updateBaud(now);
+    pushStatus(now);
 }
 
 
@@ -62,50 +66,283 @@ void Loop::setPumpCycle () {
 }
 
 
-void Loop::pollComms () {
-    uint8_t buf[8];
-    uint8_t output[8] = { 0 };
+void Loop::pollComms (uint32_t now) {
+    uint8_t output[18] = { 0 };
+    uint8_t size;
+
+    if (rx_length > 0 && now - rx_started > REQUEST_TIMEOUT) {
+        // A byte got lost, drop the partial request to get back in step.
+        rx_length = 0;
+    }
+
+    while (stream.available() > 0) {
+        if (rx_length == 0) {
+            rx_started = now;
+        }
+
+        stream.readBytes(rx + rx_length, 1);
+        rx_length++;
+
+        if (rx[0] == FRAME_START) {
+            if (rx_length == 3 && rx[2] != 8) {
+                resync();
+            } else if (rx_length == FRAMED_REQUEST) {
+                handleFrame(now);
+                return;
+            }
+        } else if (rx_length == 8) {
+            rx_length = 0;
+            size = handleCommand(rx, output, now);
+            if (size > 0) {
+                stream.write(output, size);
+            }
+            return;
+        }
+    }
+}
+
+
+// Responds to a complete framed request in rx. A repeated sequence number
+// is a retry of a request whose response got lost, the cached response is
+// sent again instead of running the command twice.
+void Loop::handleFrame (uint32_t now) {
+    uint16_t crc = crc16(rx + 1, FRAMED_REQUEST - 3);
+    uint8_t size;
+
+    if (crc != (uint16_t)((rx[FRAMED_REQUEST - 2] << 8) +
+                          rx[FRAMED_REQUEST - 1])) {
+        resync();
+        return;
+    }
+
+    rx_length = 0;
+
+    if (last_response_size == 0 || rx[1] != last_sequence) {
+        last_sequence = rx[1];
+        size = handleCommand(rx + 3, last_response + 3, now);
+        last_response_size = 0;
+
+        if (size == 0) {
+            return;
+        }
+
+        last_response[0] = FRAME_START;
+        last_response[1] = last_sequence;
+        last_response[2] = size;
+        crc = crc16(last_response + 1, size + 2);
+        PACK16(last_response, crc, size + 3);
+        last_response_size = size + 5;
+    }
+
+    stream.write(last_response, last_response_size);
+}
+
+
+// Drops the start byte of a bad frame and skips to the next candidate.
+void Loop::resync () {
+    uint8_t i = 1;
+
+    while (i < rx_length && rx[i] != FRAME_START) {
+        i++;
+    }
+
+    memmove(rx, rx + i, rx_length - i);
+    rx_length -= i;
+}
+
+
+// Runs the 8 byte request in buf, writes the response to output and
+// returns its size, 0 when nothing is to be sent.
+uint8_t Loop::handleCommand (uint8_t *buf, uint8_t *output, uint32_t now) {
+    uint8_t size = 8;
+    uint32_t requested;
     double current_setpoint;
 
-    if (stream.available() >= 8) {
-        stream.readBytes(buf, 8);
-        output[0] = buf[0];
-
-        switch (buf[0]) {
-            case COMMAND_STATUS1:
-                PACK16(output, heater_on_cycle, 1);
-                PACK16(output, heater_off_cycle, 3);
-                PACK16(output, dt, 5);
-                output[7] = heater_on & 0xff;
-                break;
-
-            case COMMAND_STATUS2:
-                PACK32(output, pump_on_cycle, 1);
-                PACKF(output, temperature, 5);
-                output[7] = pump_on & 0xff;
-                break;
-
-            case COMMAND_STATUS3:
-                PACKF(output, heater_power, 1);
-                break;
-
-            case COMMAND_SETPOINT:
-                current_setpoint = controller.getSetpoint();
-                controller.setSetpoint(buf[1] + buf[2] / 255.0);
-                PACKF(output, controller.getSetpoint(), 1);
-                PACKF(output, current_setpoint, 3);
-                break;
-
-            case COMMAND_START_PUMP:
-                pump_on_cycle = (buf[1] << 8) + buf[2];
-                break;
-
-            case COMMAND_STOP_PUMP:
-                pump_on_cycle = 0;
-                break;
+    memset(output, 0, 18);
+    output[0] = buf[0];
+
+    switch (buf[0]) {
+        case COMMAND_STATUS1:
+            PACK16(output, heater_on_cycle, 1);
+            PACK16(output, heater_off_cycle, 3);
+            PACK16(output, dt, 5);
+            output[7] = heater_on & 0xff;
+            break;
+
+        case COMMAND_STATUS2:
+            PACK32(output, pump_on_cycle, 1);
+            PACKF(output, temperature, 5);
+            output[7] = pump_on & 0xff;
+            break;
+
+        case COMMAND_STATUS3:
+            PACKF(output, heater_power, 1);
+            break;
+
+        case COMMAND_STATUS_FULL:
+            // Variable length: command, payload length, payload.
+            output[1] = 16;
+            packStatus(output + 2);
+            size = 18;
+            break;
+
+        case COMMAND_SUBSCRIBE:
+            if (buf[1] == 0 && buf[2] == 0) {
+                // End of stream frame instead of a response.
+                if (stream_interval > 0) {
+                    uint8_t frame[4];
+                    stream_interval = 0;
+                    frame[1] = COMMAND_SUBSCRIBE;
+                    writeFrame(frame, 0);
+                    return 0;
+                }
+            } else {
+                stream_interval = (buf[1] << 8) + buf[2];
+                last_push = now;
+                output[1] = buf[1];
+                output[2] = buf[2];
+                output[3] = 1;
+            }
+            break;
+
+        case COMMAND_FRAMING:
+            // A new client starts its own sequence numbers.
+            last_response_size = 0;
+            output[1] = 1;
+            output[2] = FRAMING_VERSION;
+            break;
+
+        case COMMAND_BAUD:
+            // The rate is switched in updateBaud after the response.
+            requested = ((uint32_t)buf[1] << 24) + ((uint32_t)buf[2] << 16) +
+                        ((uint32_t)buf[3] << 8) + buf[4];
+            if (change_baud != 0 && supportedBaud(requested)) {
+                pending_baud = requested;
+                output[1] = 1;
+            }
+            PACK32(output, requested, 2);
+            break;
 
+        case COMMAND_SETPOINT:
+            current_setpoint = controller.getSetpoint();
+            controller.setSetpoint(buf[1] + buf[2] / 255.0);
+            PACKF(output, controller.getSetpoint(), 1);
+            PACKF(output, current_setpoint, 3);
+            break;
+
+        case COMMAND_START_PUMP:
+            pump_on_cycle = (buf[1] << 8) + buf[2];
+            break;
+
+        case COMMAND_STOP_PUMP:
+            pump_on_cycle = 0;
+            break;
+
+        default:
+            // Unknown, or line noise at a baud rate that doesn't match.
+            return size;
+    }
+
+    if (buf[0] != COMMAND_BAUD) {
+        // A valid request at a new baud rate confirms it.
+        baud_deadline = 0;
+    }
+
+    return size;
+}
+
+
+// Switches to a requested baud rate once its response is sent, and back
+// when nothing valid arrives at the new rate in time.
+void Loop::updateBaud (uint32_t now) {
+    if (pending_baud != 0) {
+        stream.flush();
+        previous_baud = baud;
+        baud = pending_baud;
+        pending_baud = 0;
+        change_baud(baud);
+        baud_deadline = now + BAUD_CONFIRM_TIMEOUT;
+        if (baud_deadline == 0) {
+            baud_deadline = 1;
+        }
+    } else if (baud_deadline != 0 && (int32_t)(now - baud_deadline) >= 0) {
+        baud = previous_baud;
+        baud_deadline = 0;
+        change_baud(baud);
+    }
+}
+
+
+void Loop::pushStatus (uint32_t now) {
+    uint8_t record[24];
+
+    if (stream_interval == 0 || now - last_push < stream_interval) {
+        return;
+    }
+
+    last_push = now;
+    record[1] = COMMAND_STATUS_FULL;
+    PACK32(record, now, 3);
+    packStatus(record + 7);
+    writeFrame(record, 20);
+}
+
+
+void Loop::packStatus (uint8_t *output) {
+    PACK16(output, heater_on_cycle, 0);
+    PACK16(output, heater_off_cycle, 2);
+    PACK16(output, dt, 4);
+    output[6] = heater_on & 0xff;
+    PACK32(output, pump_on_cycle, 7);
+    PACKF(output, temperature, 11);
+    output[13] = pump_on & 0xff;
+    PACKF(output, heater_power, 14);
+}
+
+
+// Sends frame[1] (the kind) with the `length` payload bytes starting at
+// frame[3], sync, length and checksum are filled in here.
+void Loop::writeFrame (uint8_t *frame, uint8_t length) {
+    uint8_t checksum = 0;
+
+    frame[0] = FRAME_SYNC;
+    frame[2] = length;
+
+    for (int i = 1; i < length + 3; i++) {
+        checksum ^= frame[i];
+    }
+
+    frame[length + 3] = checksum;
+    stream.write(frame, length + 4);
+}
+
+
+// CRC-16/CCITT (polynomial 0x1021, initial value 0xffff).
+uint16_t crc16 (const uint8_t *data, uint8_t length) {
+    uint16_t crc = 0xffff;
+
+    for (uint8_t i = 0; i < length; i++) {
+        crc ^= (uint16_t)data[i] << 8;
+        for (uint8_t bit = 0; bit < 8; bit++) {
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
         }
+    }
 
-        stream.write(output, 8);
+    return crc;
+}
+
+
+bool supportedBaud (uint32_t baud) {
+    switch (baud) {
+        case 9600:
+        case 19200:
+        case 38400:
+        case 57600:
+        case 115200:
+        case 230400:
+        case 460800:
+            return true;
     }
+
+    return false;
 }
@@ -11,12 +11,38 @@ typedef enum {
     COMMAND_STATUS1        = 1,
     COMMAND_STATUS2        = 2,
     COMMAND_STATUS3        = 3,
+    COMMAND_STATUS_FULL    = 4,
+    COMMAND_SUBSCRIBE      = 5,
+    COMMAND_FRAMING        = 6,
+    COMMAND_BAUD           = 7,
     COMMAND_SETPOINT       = 10,
     COMMAND_START_PUMP     = 20,
     COMMAND_STOP_PUMP      = 21,
 } CommandType;
 
 
+// First byte of every frame pushed while subscribed.
+#define FRAME_SYNC       0xA5
+
+// Framed requests and responses: start byte, sequence number, payload
+// length, payload and a CRC-16/CCITT over sequence, length and payload.
+// No command byte equals FRAME_START, so raw 8 byte requests still work.
+#define FRAME_START      0x7E
+#define FRAMING_VERSION  1
+#define FRAMED_REQUEST   13
+
+// Milliseconds after which a partial request is dropped.
+#define REQUEST_TIMEOUT  50
+
+// Milliseconds a new baud rate has to see a valid request before the loop
+// goes back to the previous rate.
+#define BAUD_CONFIRM_TIMEOUT 1000
+
+
+// Switches the serial port to a new baud rate.
+typedef void (*BaudCallback)(uint32_t);
+
+
 class ITemperatureSensor {
   public:
     virtual double readTemperature () = 0;
@@ -35,6 +61,10 @@ class Loop {
     void          setFullCycle      (uint16_t cycle) { full_cycle = cycle; };
     int           getHeaterOn       ()  { return heater_on; };
     int           getPumpOn         ()  { return pump_on; };
+    void          setBaudCallback   (BaudCallback callback, uint32_t current) {
+        change_baud = callback;
+        baud = current;
+    };
 
   private:
     Stream              &stream;
@@ -48,7 +78,23 @@ class Loop {
 
     uint32_t             first_call        = 0,
                          last_call         = 0,
-                         pump_on_cycle     = 0;
+                         pump_on_cycle     = 0,
+                         last_push         = 0,
+                         rx_started        = 0,
+                         baud              = 0,
+                         pending_baud      = 0,
+                         previous_baud     = 0,
+                         baud_deadline     = 0;
+
+    BaudCallback         change_baud       = 0;
+
+    uint16_t             stream_interval   = 0;
+
+    uint8_t              rx[FRAMED_REQUEST],
+                         rx_length         = 0,
+                         last_sequence     = 0,
+                         last_response[23],
+                         last_response_size = 0;
 
     double               temperature       = 0.0,
                          heater_power      = 0.0;
@@ -58,8 +104,19 @@ class Loop {
 
     void                 setHeaterPower (uint32_t);
     void                 setPumpCycle   ();
-    void                 pollComms      ();
+    void                 pollComms      (uint32_t);
+    uint8_t              handleCommand  (uint8_t *, uint8_t *, uint32_t);
+    void                 handleFrame    (uint32_t);
+    void                 resync         ();
+    void                 updateBaud     (uint32_t);
+    void                 pushStatus     (uint32_t);
+    void                 packStatus     (uint8_t *);
+    void                 writeFrame     (uint8_t *, uint8_t);
 };
 
 
+uint16_t crc16 (const uint8_t *, uint8_t);
+bool     supportedBaud (uint32_t);
+
+
 #endif
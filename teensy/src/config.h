@@ -16,5 +16,7 @@
 #define HEATER_PIN       3
 #define PUMP_PIN         4
 
+#define BAUD             9600
+
 
 #endif
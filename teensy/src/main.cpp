@@ -19,6 +19,12 @@ void set_tick () {
 }
 
 
+void change_baud (uint32_t baud) {
+    Serial.flush();
+    Serial.begin(baud);
+}
+
+
 class AdaFruitSensor: public ITemperatureSensor {
   public:
     AdaFruitSensor(Adafruit_MAX31855 _sensor): sensor(_sensor) {};
@@ -44,8 +50,10 @@ extern "C" int main(void) {
     digitalWrite(PUMP_PIN, LOW);
     digitalWrite(13, HIGH);
 
-    // Init serial and delay to allow programming.
-    Serial.begin(9600);
+    // Init serial and delay to allow programming. Clients start at BAUD
+    // and can negotiate a faster rate.
+    Serial.begin(BAUD);
+    loop.setBaudCallback(change_baud, BAUD);
     delay(2500);
 
     timer.begin(set_tick, 1000);
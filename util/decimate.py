@@ -0,0 +1,89 @@
+'''
+    Decimate
+    ~~~~~~~~
+    Reduces long series to roughly what a plot can show. A line plot can't
+    draw more than a couple of points per pixel column, so hours of 1 ms
+    samples only cost time and memory once they reach matplotlib.
+'''
+
+import numpy as np
+
+
+def minmax (x, y, buckets):
+    ''' Keeps the first minimum and maximum of `y` in each of `buckets`
+        equally wide `x` ranges, plus the first and last sample.
+
+    Peaks and overshoot survive exactly, which makes this the right choice
+    for temperature curves. `x` has to be increasing.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    if n <= 2 * buckets:
+        return x, y
+
+    edges = np.linspace(x[0], x[-1], buckets + 1)
+    # Empty buckets start where the next one does, drop them.
+    starts = np.unique(np.searchsorted(x, edges[:-1]))
+    sizes = np.diff(np.append(starts, n))
+    bucket = np.repeat(np.arange(len(starts)), sizes)
+
+    low = np.minimum.reduceat(y, starts)
+    high = np.maximum.reduceat(y, starts)
+    index = np.arange(n)
+    first_low = np.minimum.reduceat(
+        np.where(y == low[bucket], index, n), starts)
+    first_high = np.minimum.reduceat(
+        np.where(y == high[bucket], index, n), starts)
+
+    keep = np.unique(np.concatenate([[0, n - 1], first_low, first_high]))
+    keep = keep[keep < n]
+    return x[keep], y[keep]
+
+
+def lttb (x, y, threshold):
+    ''' Largest-Triangle-Three-Buckets, keeps `threshold` samples.
+
+    Every bucket contributes the sample that spans the largest triangle
+    with the previously kept sample and the mean of the next bucket. The
+    shape of the curve is kept well, single sample spikes may be lost.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    if threshold < 3 or n <= threshold:
+        return x, y
+
+    every = (n - 2) / (threshold - 2)
+    bounds = np.floor(np.arange(threshold - 1) * every).astype(int) + 1
+    bounds[-1] = n - 1
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+
+    for i in range(threshold - 2):
+        start, stop = bounds[i], bounds[i + 1]
+        if i + 2 < len(bounds):
+            mean_x = x[stop:bounds[i + 2]].mean()
+            mean_y = y[stop:bounds[i + 2]].mean()
+        else:
+            mean_x, mean_y = x[-1], y[-1]
+
+        xs = x[start:stop]
+        ys = y[start:stop]
+        area = np.abs((x[a] - mean_x) * (ys - y[a]) -
+                      (x[a] - xs) * (mean_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return x[selected], y[selected]
+
+
+#: Decimation methods by name, each is called with ``(x, y, width)``.
+METHODS = {
+    'none': lambda x, y, width: (x, y),
+    'minmax': minmax,
+    'lttb': lambda x, y, width: lttb(x, y, 2 * width),
+}
@@ -5,14 +5,22 @@
 '''
 #!/usr/bin/env python
 
-import csv
+import argparse
+import concurrent.futures
+import hashlib
 import itertools
+import json
 import os
 import sys
 
+import numpy as np
+
 import matplotlib.pyplot as plt
 from matplotlib.font_manager import FontProperties
 
+import decimate
+import teensylog
+
 colors = [
     (1, 0, 1),
     (0, 1, 1),
@@ -21,34 +29,117 @@ colors = [
 ]
 
 
-plt.figure()
-logs = sys.argv[1]
+def load_log (path, method, width):
+    ''' Loads and decimates the log at `path`, this runs in the worker
+        processes and only the reduced arrays travel back.
+
+    :returns: ``(params, t, T)``, `t` in seconds.
+    '''
+    params, data = teensylog.load(path, ['t', 'T'])
+    t, T = decimate.METHODS[method](data['t'] / 1000, data['T'], width)
+    return params, np.array(t, dtype=float), np.array(T, dtype=float)
+
+
+class Cache (object):
+    ''' A directory of ``<key>.npz`` results of :func:`load_log`, the key
+        covers the log's path, size and mtime and the decimation.
+    '''
+
+    def __init__ (self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+
+    def filename (self, path, method, width):
+        stat = os.stat(path)
+        description = json.dumps([os.path.abspath(path), stat.st_size,
+                                  stat.st_mtime_ns, method, width])
+        key = hashlib.sha1(description.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}.npz'.format(key))
+
 
-for color, entry in zip(itertools.cycle(colors), os.listdir(logs)):
-    if not entry.endswith('.log'):
-        continue
+    def load (self, path, method, width):
+        try:
+            with np.load(self.filename(path, method, width)) as data:
+                return json.loads(str(data['params'])), data['t'], data['T']
+        except (OSError, ValueError, KeyError):
+            return None
 
-    path = os.path.join(logs, entry)
-    with open(path) as fp:
-        reader = csv.reader(fp, delimiter='\t')
-        params = dict(_.split('=') for _ in next(reader)[1:])
-        headers = next(reader)
-        index_t = headers.index('t')
-        index_T = headers.index('T')
 
-        t_, T_ = zip(*((row[index_t], row[index_T]) for row in reader))
-        t = [float(_) / 1000 for _ in t_]
-        T = map(float, T_)
+    def store (self, path, method, width, result):
+        filename = self.filename(path, method, width)
+        partial = '{}.{}.tmp.npz'.format(filename[:-4], os.getpid())
+        params, t, T = result
+        np.savez(partial, params=json.dumps(params), t=t, T=T)
+        os.replace(partial, filename)
 
-        plt.plot(t, list(T), label='Tm (Kp={})'.format(params['Kp']),
+
+def load_logs (paths, method, width, cache='.plotcache', workers=None):
+    ''' Runs :func:`load_log` for `paths` in a process pool and returns the
+        results in the same order. Unchanged logs come from `cache`.
+    '''
+    cache = Cache(cache) if cache else None
+    results = [None] * len(paths)
+    todo = {}
+
+    for i, path in enumerate(paths):
+        result = cache.load(path, method, width) if cache else None
+        if result is None:
+            todo[i] = path
+        else:
+            results[i] = result
+
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(load_log, path, method, width): i
+                       for i, path in todo.items()}
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                if cache:
+                    cache.store(paths[i], method, width, results[i])
+
+    return results
+
+
+def main ():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', help='Directory with .log, .tlog or .crec files.')
+    parser.add_argument('-o', '--output', default='imbabimbaresult_pid.png')
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('-d', '--decimate', default='minmax',
+        choices=sorted(decimate.METHODS),
+        help='minmax keeps the peaks of every pixel column, lttb the '
+             'overall shape.')
+    parser.add_argument('-w', '--width', type=int, default=None,
+        help='Pixel columns to decimate to, defaults to the figure width.')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--cache', default='.plotcache',
+        help='Cache directory, empty to disable.')
+    args = parser.parse_args()
+
+    figure = plt.figure()
+    width = args.width or int(figure.get_figwidth() * args.dpi)
+    paths = [os.path.join(args.logs, _) for _ in sorted(os.listdir(args.logs))
+             if _.endswith(('.log', '.tlog', '.crec'))]
+    results = load_logs(paths, args.decimate, width, args.cache,
+                        args.workers)
+
+    for color, (params, t, T) in zip(itertools.cycle(colors), results):
+        plt.plot(t, T,
+                 label='Tm (Kp={})'.format(params.get('Kp', '?')),
                  color=color, linewidth=1)
 
+    plt.xlabel('time')
+
+    font_properties = FontProperties()
+    font_properties.set_size('x-small')
+    legend = plt.legend(loc=0, prop=font_properties)
+    plt.setp(legend.get_title(), fontsize='x-small')
 
-plt.xlabel('time')
+    plt.savefig(args.output, dpi=args.dpi)
+    return 0
 
-font_properties = FontProperties()
-font_properties.set_size('x-small')
-legend = plt.legend(loc=0, prop=font_properties)
-plt.setp(legend.get_title(), fontsize='x-small')
 
-plt.savefig("imbabimbaresult_pid.png", dpi=150)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,12 +5,20 @@
 
 import argparse
 import csv
+import itertools
 import time
 import os
 import sys
 
+import numpy as np
 
-def create_filename (Kp, Ki, Kd, setpoint):
+import teensylog
+
+
+HEADERS = ['On', 'T', 'Output', 'dt', 'cycle', 't']
+
+
+def create_filename (Kp, Ki, Kd, setpoint, extension='log'):
     parts = [
         'teensy-output',
         'Kp={}'.format(Kp),
@@ -18,17 +26,33 @@ def create_filename (Kp, Ki, Kd, setpoint):
         'Kd={}'.format(Kd),
         time.strftime('%Y-%m-%d_%H,%M')
     ]
-    return '{}.log'.format('_'.join(parts))
+    return '{}.{}'.format('_'.join(parts), extension)
 
 
-def log_lines (log):
+def data_lines (log):
     for line in log:
         line = line.strip()
         if line == '' or line[0] == ':':
             continue
+        yield line
+
+
+def log_lines (log):
+    for line in data_lines(log):
         yield [float(_) for _ in line.split('\t')]
 
 
+def write_binary (log, filename, params, date):
+    ''' Writes the data lines of `log` as a binary columnar log. '''
+    lines = data_lines(log)
+    with teensylog.BinaryWriter(filename, HEADERS, params, date) as writer:
+        while True:
+            chunk = list(itertools.islice(lines, teensylog.CHUNKSIZE))
+            if not chunk:
+                break
+            writer.write(np.loadtxt(chunk, delimiter='\t', ndmin=2))
+
+
 def main ():
     parser = argparse.ArgumentParser()
     parser.add_argument('logfile', help='Log file from the teensy.')
@@ -37,6 +61,8 @@ def main ():
     parser.add_argument('kd', default=0, nargs='?', type=float)
     parser.add_argument('setpoint', default=100, nargs='?', type=float)
     parser.add_argument('cycle', default=500, nargs='?', type=int)
+    parser.add_argument('-b', '--binary', action='store_true',
+        help='Write a memory-mappable binary log (.tlog).')
 
     args = parser.parse_args()
 
@@ -49,12 +75,26 @@ def main ():
     Kd = args.kd
     setpoint = args.setpoint
 
-    filename = create_filename(Kp, Ki, Kd, setpoint)
+    filename = create_filename(Kp, Ki, Kd, setpoint,
+        'tlog' if args.binary else 'log')
 
     if os.path.isfile(filename):
         print('Output file {} already exists.'.format(filename))
         return -2
 
+    if args.binary:
+        params = {
+            'Kp': str(Kp),
+            'Ki': str(Ki),
+            'Kd': str(Kd),
+            'setpoint': str(setpoint),
+            'cycle': str(args.cycle),
+        }
+        with open(args.logfile) as log:
+            write_binary(log, filename, params,
+                time.strftime('%Y-%m-%d %H:%M:%S'))
+        return 0
+
     with open(args.logfile) as log, open(filename, 'w') as out:
         vals = log_lines(log)
         writer = csv.writer(out, delimiter='\t')
@@ -67,7 +107,7 @@ def main ():
             'setpoint={}'.format(setpoint),
             'cycle={}'.format(args.cycle),
         ])
-        writer.writerow(['On','T','Output', 'dt', 'cycle', 't'])
+        writer.writerow(HEADERS)
         writer.writerows(vals)
 
 
@@ -0,0 +1,293 @@
+'''
+    Teensy logs
+    ~~~~~~~~~~~
+    Reads the logs written by ``postprocess.py``: a line with the date and
+    the ``Kp=..`` style parameters, a line with the column headers and then
+    tab separated rows. Rows are parsed in chunks straight into NumPy
+    arrays, so a multi-hour log never exists as Python objects at once.
+
+    The binary variant stores the same data column by column: :data:`MAGIC`,
+    a little-endian uint32 header length, a JSON header with the date,
+    parameters, row count and column layout, then every column as a typed
+    array at an :data:`ALIGNMENT` byte boundary. It is read with
+    ``np.memmap`` and opens without parsing anything.
+
+    Binary recordings of ``coffee.py record`` (``.crec``) are read as well:
+    :data:`RECORDING_MAGIC`, the header length and a JSON header with the
+    record dtype, then one packed record per row.
+'''
+
+import itertools
+import json
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+
+#: Number of rows parsed at a time.
+CHUNKSIZE = 65536
+
+#: First bytes of a binary log.
+MAGIC = b'TLOG\x00\x01\r\n'
+
+#: First bytes of a ``coffee.py record`` binary recording.
+RECORDING_MAGIC = b'CREC\x00\x01\r\n'
+
+#: Column data in binary logs starts at a multiple of this offset.
+ALIGNMENT = 64
+
+#: Column types in binary logs, other columns are stored as float64.
+COLUMN_TYPES = {
+    'On': '|u1',
+    'T': '<f4',
+    'Output': '<f4',
+    'dt': '<u2',
+    'cycle': '<u4',
+    't': '<u4',
+}
+
+
+def parse_params (fields):
+    ''' Returns the ``key=value`` fields as a dict of strings. '''
+    return dict(_.split('=', 1) for _ in fields if '=' in _)
+
+
+class LogReader (object):
+    ''' Reads a log in chunks of `chunksize` rows.
+
+    :param path: The log file.
+    :param columns: Names of the columns to load, by default all of them.
+    :param t_range: Optional ``(start, stop)`` in the unit of the ``t``
+                    column (milliseconds). Rows outside are dropped and
+                    reading stops after `stop`, ``t`` is increasing in
+                    teensy logs.
+    '''
+
+    def __init__ (self, path, columns=None, t_range=None,
+                  chunksize=CHUNKSIZE):
+        self.fp = open(path)
+        self.chunksize = chunksize
+        self.t_range = t_range
+
+        first = self.fp.readline().rstrip('\n').split('\t')
+        self.date = first[0]
+        self.params = parse_params(first[1:])
+        self.headers = self.fp.readline().rstrip('\n').split('\t')
+
+        self.columns = list(columns or self.headers)
+        for name in self.columns:
+            if name not in self.headers:
+                raise KeyError('{}: no column {}'.format(path, name))
+
+        # Parse `t` as well when it is needed to select the time range.
+        parsed = list(self.columns)
+        if t_range is not None and 't' not in parsed:
+            parsed.append('t')
+        self.parsed = parsed
+        self.usecols = [self.headers.index(_) for _ in parsed]
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+
+    def __iter__ (self):
+        return self.chunks()
+
+
+    def close (self):
+        self.fp.close()
+
+
+    def chunks (self):
+        ''' Yields a dict of column arrays per chunk. '''
+        while True:
+            lines = list(itertools.islice(self.fp, self.chunksize))
+            if not lines:
+                return
+
+            data = np.loadtxt(lines, delimiter='\t', usecols=self.usecols,
+                              ndmin=2)
+            chunk = dict(zip(self.parsed, data.T))
+
+            done = False
+            if self.t_range is not None:
+                start, stop = self.t_range
+                t = chunk['t']
+                done = t[-1] >= stop
+                keep = (t >= start) & (t < stop)
+                chunk = {k: chunk[k][keep] for k in self.columns}
+
+            yield chunk
+
+            if done:
+                return
+
+
+    def load (self):
+        ''' Returns the remaining rows as a dict of column arrays. '''
+        parts = list(self.chunks())
+        if not parts:
+            return {k: np.empty(0) for k in self.columns}
+        return {k: np.concatenate([_[k] for _ in parts])
+                for k in self.columns}
+
+
+class BinaryWriter (object):
+    ''' Writes a binary log, rows are added in chunks with :meth:`write`.
+
+    Every column is spooled to its own temporary file, :meth:`close`
+    writes the header and copies the columns into place.
+    '''
+
+    def __init__ (self, path, headers, params, date=''):
+        self.path = path
+        self.headers = list(headers)
+        self.params = params
+        self.date = date
+        self.dtypes = [np.dtype(COLUMN_TYPES.get(_, '<f8'))
+                       for _ in self.headers]
+        self.spools = [tempfile.TemporaryFile() for _ in self.headers]
+        self.rows = 0
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+
+    def write (self, rows):
+        ''' Appends `rows`, a 2-D array with a column per header. '''
+        rows = np.asarray(rows).reshape(-1, len(self.headers))
+        for spool, dtype, column in zip(self.spools, self.dtypes, rows.T):
+            spool.write(column.astype(dtype).tobytes())
+        self.rows += len(rows)
+
+
+    def close (self):
+        if self.spools is None:
+            return
+
+        columns = []
+        offset = 0
+        for name, dtype in zip(self.headers, self.dtypes):
+            columns.append({'name': name, 'dtype': dtype.str,
+                            'offset': offset})
+            offset += align(self.rows * dtype.itemsize)
+
+        header = json.dumps({
+            'date': self.date,
+            'params': self.params,
+            'rows': self.rows,
+            'columns': columns,
+        }).encode('utf-8')
+
+        # Column offsets in the header are relative to the data start.
+        start = align(len(MAGIC) + 4 + len(header))
+
+        with open(self.path, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<I', len(header)))
+            out.write(header)
+
+            for spool, column in zip(self.spools, columns):
+                out.seek(start + column['offset'])
+                spool.seek(0)
+                shutil.copyfileobj(spool, out)
+                spool.close()
+
+            out.truncate(start + offset)
+
+        self.spools = None
+
+
+def align (size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def is_binary (path):
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) in (MAGIC, RECORDING_MAGIC)
+
+
+def open_binary (path):
+    ''' Returns ``(date, params, columns)`` of a binary log, `columns` maps
+        every column name to a read-only ``np.memmap``.
+    '''
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{}: not a binary log'.format(path))
+        size, = struct.unpack('<I', fp.read(4))
+        header = json.loads(fp.read(size).decode('utf-8'))
+
+    start = align(len(MAGIC) + 4 + size)
+    columns = {}
+    for column in header['columns']:
+        if header['rows'] == 0:
+            columns[column['name']] = np.empty(0, column['dtype'])
+            continue
+        columns[column['name']] = np.memmap(
+            path, column['dtype'], 'r', start + column['offset'],
+            (header['rows'],))
+
+    return header['date'], header['params'], columns
+
+
+def open_recording (path):
+    ''' Returns ``(date, params, columns)`` of a binary recording like
+        :func:`open_binary`. A partly written last record is left out.
+    '''
+    with open(path, 'rb') as fp:
+        if fp.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError('{}: not a binary recording'.format(path))
+        size, = struct.unpack('<I', fp.read(4))
+        header = json.loads(fp.read(size).decode('utf-8'))
+        start = fp.tell()
+        fp.seek(0, 2)
+        end = fp.tell()
+
+    dtype = np.dtype([tuple(_) for _ in header['dtype']])
+    rows = (end - start) // dtype.itemsize
+    if rows == 0:
+        records = np.empty(0, dtype)
+    else:
+        records = np.memmap(path, dtype, 'r', start, (rows,))
+
+    return header['date'], header['params'], \
+        {name: records[name] for name in header['columns']}
+
+
+def load (path, columns=None, t_range=None, chunksize=CHUNKSIZE):
+    ''' Returns ``(params, data)`` of the log at `path`, `data` holds an
+        array per column. See :class:`LogReader` for the arguments.
+
+    Binary logs and recordings are memory-mapped instead of parsed, `data`
+    then holds ``np.memmap`` slices.
+    '''
+    if is_binary(path):
+        with open(path, 'rb') as fp:
+            recording = fp.read(len(RECORDING_MAGIC)) == RECORDING_MAGIC
+        _, params, data = (open_recording if recording else open_binary)(path)
+        columns = list(columns or data)
+        for name in columns:
+            if name not in data:
+                raise KeyError('{}: no column {}'.format(path, name))
+
+        selection = slice(None)
+        if t_range is not None:
+            start, stop = np.searchsorted(data['t'], t_range)
+            selection = slice(start, stop)
+
+        return params, {k: data[k][selection] for k in columns}
+
+    with LogReader(path, columns, t_range, chunksize) as reader:
+        return reader.params, reader.load()